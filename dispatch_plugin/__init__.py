@@ -1,87 +1,78 @@
 # Dispatch alerts to external executables.
-import json
-import subprocess
+import time
 import threading
-import errno
-from datetime import datetime
 
-class DispatchPlugin(object):
-    plugin_name = 'DispatchPlugin'
+from ecs.metrics import metrics
+from ecs.supervisor import supervisor
+from ecs.retry import RetryScheduler
+from .commands import compile_commands
 
-    def __init__(self, config, logging, **kw):
-        self.l = logging
-        self.config = config
-        self.request = kw['request']
-        self.plugin_name = self.l.name.lstrip('ecs_')
-        self.now = datetime.now()
+# Alert parameters every command can rely on
+REQUIRED_FIELDS = ('status', 'monitor', 'device')
 
-        # Use global timeout if available
-        if self.config.has_option(self.plugin_name, 'timeout'):
-            self.timeout = self.config.getint(self.plugin_name, 'timeout')
-        else:
-            self.timeout = False
-
-    # Helper method to timeout command dispatches
-    def _timeout_callback(self, p):
-        if p.poll() is None:
-            try:
-                p.kill()
-                self.l.error('Process {pid} taking too long, killing'.format(
-                    pid=p.pid
-                ))
-            except OSError as e:
-                if e.errno != errno.ESRCH:
-                    raise
-
-    # Helper method to extract commands and inputs from the configuration
-    def get_commands(self):
-        commands = []
-        for key, item in self.config.items(self.plugin_name):
-            if key.startswith('command'):
-                command = item
-                # Find corresponding input or use False
-                try:
-                    input_data = self.config.get(
-                        self.plugin_name,
-                        'input{0}'.format(
-                            key.split('command')[-1]
-                        )
-                    )
-                except Exception as e:
-                    self.l.exception('No input data for plugin')
-                    input_data = False
-                    pass
+metrics.histogram(
+    'ecs_dispatch_spawn_seconds',
+    'Time spent starting a command and writing its input, by command.'
+)
+metrics.histogram(
+    'ecs_dispatch_run_seconds',
+    'Time from start to exit of a command, by command.'
+)
+metrics.counter(
+    'ecs_dispatch_exits_total',
+    'Commands that exited, by command and exit code.'
+)
+metrics.counter(
+    'ecs_dispatch_timeout_kills_total',
+    'Commands stopped for running past their timeout, by command.'
+)
+metrics.gauge(
+    'ecs_dispatch_running',
+    'Commands running right now.',
+    supervisor.running
+)
+metrics.counter(
+    'ecs_dispatch_retries_total',
+    'Failed commands run again, by command.'
+)
+metrics.counter(
+    'ecs_dispatch_dead_letters_total',
+    'Commands given up on after their last attempt failed, by command.'
+)
 
-                if input_data == 'False':
-                    input_data = False
 
-                # If no global timeout is defined, try to find local
-                if self.timeout is False:
-                    try:
-                        local_timeout = self.config.getint(
-                            self.plugin_name,
-                            'timeout{0}'.format(
-                                key.split('command')[-1]
-                            )
-                        )
-                    except Exception as e:
-                        self.l.exception('No local timeout for plugin')
-                        local_timeout = False
-                        pass
-                else:
-                    local_timeout = False
+# One command for one alert, retried when it fails
+class CommandJob(object):
+
+    def __init__(self, command, alert):
+        self.command = command
+        self.alert = alert
+        self.name = '{command} for alert {alert}'.format(
+            command=command.name,
+            alert=alert.get('alert', '')
+        )
+
+    def record(self):
+        return {'command': self.command.name, 'alert': self.alert.record()}
+
 
-                commands.append({
-                    'command': command,
-                    'input': input_data,
-                    'timeout': local_timeout
-                })
+# Why a finished command counts as failed, None if it succeeded
+def failure_reason(child):
+    if child.killed:
+        return 'killed after {timeout}s timeout'.format(timeout=child.timeout)
+    if child.returncode:
+        return 'exit {code}'.format(code=child.returncode)
+    return None
 
-        return commands
 
-    # run() is executed by plugin engine
-    def run(self):
-        request = self.request
+class DispatchPlugin(object):
+    plugin_name = 'DispatchPlugin'
+
+    # setup() is executed once when the plugin engine loads the plugin
+    def setup(self, config, logging):
+        self.l = logging
+        self.config = config
+        self.plugin_name = self.l.name.lstrip('ecs_')
 
         if not self.config.has_section(self.plugin_name):
             self.l.error('Must configure {plugin}'.format(
@@ -89,116 +80,225 @@ class DispatchPlugin(object):
             ))
             raise NotImplementedError
 
-        alert = request.params.get('status', '').split(',')[0]
-        alert_time_period_state = request.params.get(
+        # Seconds between SIGTERM and SIGKILL for commands that time out
+        if self.config.has_option(self.plugin_name, 'kill_grace'):
+            supervisor.kill_grace = self.config.getint(
+                self.plugin_name,
+                'kill_grace'
+            )
+
+        # How many commands may run at the same time for one alert
+        if self.config.has_option(self.plugin_name, 'max_parallel'):
+            self.max_parallel = self.config.getint(
+                self.plugin_name,
+                'max_parallel'
+            )
+        else:
+            self.max_parallel = 4
+
+        # Parse and check every command template once, a bad template
+        # raises here and disables the plugin.
+        self.commands = compile_commands(self.config, self.plugin_name)
+
+        # Commands that fail or time out are run again with backoff, those
+        # that fail every attempt are written to the dead-letter file
+        def option(name, default, getter='get'):
+            if self.config.has_option(self.plugin_name, name):
+                return getattr(self.config, getter)(self.plugin_name, name)
+            return default
+
+        self.retries = None
+        max_attempts = option('retry_max_attempts', 1, 'getint')
+        dead_letter = option('retry_dead_letter', '')
+        if max_attempts > 1 or dead_letter:
+            self.retries = RetryScheduler(
+                self.retry,
+                max_attempts=max_attempts,
+                backoff=option('retry_backoff', 10, 'getfloat'),
+                backoff_max=option('retry_backoff_max', 300, 'getfloat'),
+                dead_letter=dead_letter,
+                name='ecs-dispatch-retry'
+            )
+            metrics.gauge(
+                'ecs_dispatch_retries_pending',
+                'Failed commands waiting to be run again.',
+                lambda: len(self.retries)
+            )
+
+    # handle() is executed by plugin engine for each alert
+    def handle(self, alert):
+        alert_time_period_state = alert.get(
             'alert_time_period_state',
             ''
         )
 
         # Check if alert is in scheduled downtime state
         if alert_time_period_state == 'DOWN':
-            self.l.debug('Monitor {monitor}: Skipped while in downtime period'.format(
-                monitor=request.params.get('monitor', '')
-            ))
+            self.l.debug(
+                'Monitor %s: Skipped while in downtime period',
+                alert.get('monitor', '')
+            )
         else:
-            for command in self.get_commands():
-                if self.timeout:
-                    timeout = self.timeout
-                else:
-                    timeout = command['timeout']
-
-                self.execute(
-                    command['command'],
-                    command['input'],
-                    timeout
+            # Check if relevant values are set
+            missing = alert.missing(REQUIRED_FIELDS)
+            if missing:
+                raise ValueError('Must provide {field} argument'.format(
+                    field=missing[0]
+                ))
+
+            results = self.run_commands(alert)
+
+            self.l.info('Alert {alert}: {summary}'.format(
+                alert=alert.get('alert', ''),
+                summary=', '.join(
+                    '{name} exit {code} in {duration:.3f}s'.format(
+                        name=name,
+                        code=code,
+                        duration=duration
+                    ) for name, (code, duration) in results
                 )
+            ))
 
-    # This executes the configured commands
-    def execute(self, command, input_data=False, timeout=False):
-        request = self.request
-
-        command_args = []
-        _command_args = command.split(' ')
-
-        # Check if relevant values are set
-        if not len(request.params.get('status', '')):
-            raise StandardError('Must provide status argument')
-
-        if not len(request.params.get('monitor', '')):
-            raise StandardError('Must provide monitor argument')
-
-        if not len(request.params.get('device', '')):
-            raise StandardError('Must provide device_hostname argument')
-
-        # This dict gets passed into command formats and input formats
-        format_data = {
-            'time': self.now,
-            'alert': request.params.get('alert', ''),
-            'status': request.params.get('status', ''),
-            'monitor': request.params.get('monitor', ''),
-            'organisation': request.params.get('organisation', ''),
-            'alert_time_period_state': request.params.get(
-                'alert_time_period_state',
-                ''
-            ),
-            'device': request.params.get('device', ''),
-            'device_hostname': request.params.get('device_hostname', ''),
-            'monitor_name': request.params.get('monitor_name', ''),
-            'monitor_type': request.params.get('monitor_type', '')
-        }
-
-        # Format command arguments
-        for _cmd in _command_args:
-            command_args.append(_cmd.format(**format_data))
-
-        if input_data:
-            proc_stdin = subprocess.PIPE
-        else:
-            proc_stdin = None
+    # Run commands at the same time, at most max_parallel at once. A command
+    # with an after rule is started once the commands it names have finished.
+    # Returns a list of (name, (exit code, duration)) in the order commands
+    # finished, the exit code is None if the command raised an exception.
+    # Failed commands are handed to the retry scheduler.
+    def run_commands(self, alert):
+        # The alert context gets passed into command formats and input
+        # formats, it is built once per alert and shared by every command
+        format_data = alert.context()
+        pending = list(self.commands)
+        running = set()
+        results = []
+        finished = set()
+        cond = threading.Condition()
 
-        proc = subprocess.Popen(
-            command_args,
-            stdin=proc_stdin
-        )
+        def command_done(command, child):
+            name = command.name
+            code, duration = child.returncode, child.duration
+            self.command_exited(name, child)
 
-        self.l.debug('Executed command[{pid}]: {input} | {command}'.format(
-            input=input_data,
-            command=command_args,
-            pid=proc.pid
-        ))
+            reason = failure_reason(child)
+            if reason is not None:
+                self.command_failed(CommandJob(command, alert), 1, reason)
 
-        # Start a thread to create a timeout poller for proc
-        timer = threading.Timer(timeout, self._timeout_callback, [proc])
-        timer.start()
+            with cond:
+                results.append((name, (code, duration)))
+                finished.add(name)
+                running.discard(name)
+                cond.notify()
 
-        # Handle process input
-        if input_data:
-            # Process JSON list as input
-            if input_data.startswith('[') and input_data.endswith(']'):
-                input_lines = json.loads(input_data)
-                input_data = '\n'.join(input_lines)
+        with cond:
+            while pending or running:
+                for command in list(pending):
+                    if len(running) >= self.max_parallel:
+                        break
 
-            (stdout, stderr) = proc.communicate(input_data.format(**format_data))
+                    if not finished.issuperset(command.after):
+                        continue
 
-            if stderr:
-                self.l.error(
-                    'Error in process communication: {stderr}'.format(
-                        stderr=stderr
-                    )
-                )
-        else:
-            (stdout, stderr) = proc.communicate()
+                    pending.remove(command)
+                    running.add(command.name)
+
+                    try:
+                        self.execute(
+                            command,
+                            format_data,
+                            callback=lambda child, command=command:
+                                command_done(command, child)
+                        )
+                    except Exception as e:
+                        self.l.exception('{command} raised exception'.format(
+                            command=command.name
+                        ))
+                        self.command_failed(
+                            CommandJob(command, alert),
+                            1,
+                            'exception: {error}'.format(error=str(e))
+                        )
+                        running.discard(command.name)
+                        finished.add(command.name)
+                        results.append((command.name, (None, 0.0)))
+
+                if not running:
+                    break
+
+                cond.wait()
 
-        # End the timer thread if it hasn't already
-        timer.cancel()
-        timer.join()
+        return results
 
-        if stderr:
-            self.l.error('Error in process communication: {stderr}'.format(
-                stderr=stderr
+    def command_exited(self, name, child):
+        labels = (('command', name),)
+        metrics.observe('ecs_dispatch_run_seconds', child.duration, labels)
+        metrics.inc('ecs_dispatch_exits_total', labels + (
+            ('code', child.returncode),
+        ))
+        if child.killed:
+            metrics.inc('ecs_dispatch_timeout_kills_total', labels)
+
+    def command_failed(self, job, attempt, reason):
+        if self.retries is None:
+            return
+        if not self.retries.failed(job, attempt, reason):
+            metrics.inc('ecs_dispatch_dead_letters_total', (
+                ('command', job.command.name),
             ))
 
-        if stdout:
-            self.l.info('stdout: {stdout}'.format(
-                stdout=stdout
+    # Called by the retry scheduler to run a failed command again, without
+    # waiting for it to exit
+    def retry(self, job, attempt):
+        metrics.inc('ecs_dispatch_retries_total', (
+            ('command', job.command.name),
+        ))
+
+        def retry_done(child):
+            self.command_exited(job.command.name, child)
+            reason = failure_reason(child)
+            if reason is None:
+                self.l.info('Alert {alert}: {command} exit 0 on attempt {attempt}'.format(
+                    alert=job.alert.get('alert', ''),
+                    command=job.command.name,
+                    attempt=attempt
+                ))
+            else:
+                self.command_failed(job, attempt, reason)
+
+        try:
+            self.execute(
+                job.command,
+                job.alert.context(),
+                callback=retry_done
+            )
+        except Exception as e:
+            self.command_failed(job, attempt, 'exception: {error}'.format(
+                error=str(e)
             ))
+
+    # This starts one of the configured commands under the process supervisor
+    # and returns the supervised child. The callback is called with the child
+    # once it has exited.
+    def execute(self, command, format_data, callback=None):
+        command_args, input_data = command.render(format_data)
+
+        start = time.time()
+        child = supervisor.spawn(
+            command_args,
+            input_data=input_data,
+            timeout=command.timeout,
+            callback=callback
+        )
+        metrics.observe(
+            'ecs_dispatch_spawn_seconds',
+            time.time() - start,
+            (('command', command.name),)
+        )
+
+        self.l.debug(
+            'Executed command[%s]: %s | %s',
+            child.pid,
+            input_data,
+            command_args
+        )
+
+        return child
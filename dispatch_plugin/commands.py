@@ -0,0 +1,139 @@
+# Compiled command table for the DispatchPlugin.
+#
+# Commands, inputs, timeouts and after rules are parsed and checked once when
+# the configuration is loaded. Dispatching an alert is then one render pass
+# over the prepared templates.
+
+import json
+import shlex
+from string import Formatter
+
+from ecs.alert import ALERT_PARAMS, SUMMARY_PARAMS
+
+# Values available to command and input templates, see Alert.context()
+ALERT_FIELDS = ('time',) + ALERT_PARAMS + SUMMARY_PARAMS
+
+_formatter = Formatter()
+
+
+# Return the alert fields used by a format template, raises ValueError for
+# malformed templates or fields that are not alert fields.
+def template_fields(template):
+    fields = set()
+    for literal, field, spec, conversion in _formatter.parse(template):
+        if field is None:
+            continue
+
+        name = field.split('.')[0].split('[')[0]
+        if name not in ALERT_FIELDS:
+            raise ValueError('Unknown field {{{field}}} in {template!r}'.format(
+                field=field,
+                template=template
+            ))
+        fields.add(name)
+    return fields
+
+
+class Command(object):
+
+    def __init__(self, name, command, input_data=False, timeout=None,
+                 after=()):
+        self.name = name
+        self.command = command
+        self.timeout = timeout
+        self.after = list(after)
+        self.fields = set()
+
+        # Arguments without fields are kept as they are and never formatted
+        self.args = []
+        for arg in shlex.split(command):
+            fields = template_fields(arg)
+            self.fields |= fields
+            self.args.append((arg, bool(fields)))
+
+        if not self.args:
+            raise ValueError('{name}: Empty command'.format(name=name))
+
+        # JSON list input is joined into lines here instead of per alert
+        if input_data and input_data.startswith('[') and input_data.endswith(']'):
+            input_data = '\n'.join(json.loads(input_data))
+        self.input = input_data or None
+        if self.input:
+            self.fields |= template_fields(self.input)
+
+    # Render the argument list and input for one alert
+    def render(self, format_data):
+        args = [
+            _formatter.vformat(arg, (), format_data) if formatted else arg
+            for arg, formatted in self.args
+        ]
+
+        if self.input:
+            return args, _formatter.vformat(self.input, (), format_data)
+        return args, None
+
+
+# Build the command table from a configuration section. Raises ValueError
+# for templates, timeouts or after rules that cannot work.
+def compile_commands(config, section):
+    options = dict(config.items(section))
+
+    # Global timeout overrides the per command timeouts
+    global_timeout = options.get('timeout')
+
+    commands = []
+    for key, value in config.items(section):
+        if not key.startswith('command'):
+            continue
+
+        suffix = key[len('command'):]
+
+        input_data = options.get('input' + suffix, False)
+        if input_data == 'False':
+            input_data = False
+
+        timeout = global_timeout or options.get('timeout' + suffix)
+        if timeout:
+            try:
+                timeout = int(timeout)
+            except ValueError:
+                raise ValueError('{name}: Invalid timeout {timeout!r}'.format(
+                    name=key,
+                    timeout=timeout
+                ))
+        else:
+            timeout = None
+
+        after = [
+            a.strip() for a in options.get('after' + suffix, '').split(',')
+            if a.strip()
+        ]
+
+        try:
+            commands.append(Command(key, value, input_data, timeout, after))
+        except ValueError as e:
+            raise ValueError('{name}: {error}'.format(name=key, error=e))
+
+    names = set(c.name for c in commands)
+    for command in commands:
+        for name in command.after:
+            if name not in names:
+                raise ValueError('{name}: Unknown command {after} in after'.format(
+                    name=command.name,
+                    after=name
+                ))
+
+    # Make sure every command can eventually start
+    started = set()
+    remaining = list(commands)
+    while remaining:
+        ready = [c for c in remaining if started.issuperset(c.after)]
+        if not ready:
+            raise ValueError('Circular after rules between {names}'.format(
+                names=', '.join(c.name for c in remaining)
+            ))
+        for command in ready:
+            started.add(command.name)
+            remaining.remove(command)
+
+    return commands
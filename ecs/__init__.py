@@ -0,0 +1,2 @@
+# Core components of the Monitorscout ECS API, shared by ecsapi.py and the
+# plugins.
@@ -0,0 +1,146 @@
+# Parsed alert shared by every plugin.
+#
+# An alert is parsed and checked once per callback, plugins then all get the
+# same read-only object. The template context used by DispatchPlugin and
+# dispatch_ms is built once per alert, and the compact record form is what
+# goes into the spool and to the dispatch_ms service.
+
+import json
+import time
+from datetime import datetime
+try:
+    from types import MappingProxyType
+except ImportError:
+    # Python 2 has no read-only view of a dict, hand out copies instead
+    MappingProxyType = dict
+
+# Parameters sent by Monitorscout ECS
+ALERT_PARAMS = (
+    'alert',
+    'status',
+    'monitor',
+    'organisation',
+    'alert_time_period_state',
+    'device',
+    'device_hostname',
+    'monitor_name',
+    'monitor_type'
+)
+
+# Added to the summary sent in place of alerts suppressed by rate limits
+SUMMARY_PARAMS = (
+    'suppressed',
+    'summary'
+)
+
+text_type = type(u'')
+
+
+class InvalidAlert(ValueError):
+    pass
+
+
+# Parameter values are text, numbers are accepted and converted
+def param_value(key, value):
+    if value is None:
+        return u''
+    if isinstance(value, (text_type, str)):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return u'{0}'.format(value)
+    raise InvalidAlert('Parameter {key} is not a string or number'.format(
+        key=key
+    ))
+
+
+class Alert(object):
+    __slots__ = ('_params', 'received', '_context')
+
+    def __init__(self, params, received=None):
+        object.__setattr__(self, '_params', dict(params))
+        object.__setattr__(self, 'received', received or time.time())
+        object.__setattr__(self, '_context', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Alert is read-only')
+
+    # Read-only view of the parameters, copy it to change them
+    @property
+    def params(self):
+        return MappingProxyType(self._params)
+
+    # Parse request parameters or a bulk record, raises InvalidAlert if a
+    # value is not text or a required parameter is missing or empty.
+    @classmethod
+    def from_params(cls, params, required=()):
+        alert = cls(
+            (key, param_value(key, value)) for key, value in params.items()
+        )
+
+        missing = alert.missing(required)
+        if missing:
+            raise InvalidAlert('Missing parameters: {params}'.format(
+                params=', '.join(missing)
+            ))
+        return alert
+
+    # Reverse of record() and dumps(). Also accepts the plain parameter
+    # dicts that were spooled or sent to dispatch_ms before.
+    @classmethod
+    def loads(cls, data):
+        if not isinstance(data, dict):
+            data = json.loads(data)
+
+        if isinstance(data.get('p'), dict):
+            return cls(data['p'], data.get('t'))
+        return cls.from_params(data)
+
+    def record(self):
+        return {'p': dict(self._params), 't': self.received}
+
+    def dumps(self):
+        return json.dumps(
+            {'p': self._params, 't': self.received},
+            separators=(',', ':')
+        )
+
+    def missing(self, fields):
+        return [field for field in fields if not self._params.get(field)]
+
+    def get(self, key, default=None):
+        return self._params.get(key, default)
+
+    def __getitem__(self, key):
+        return self._params[key]
+
+    def __contains__(self, key):
+        return key in self._params
+
+    def __iter__(self):
+        return iter(self._params)
+
+    def __len__(self):
+        return len(self._params)
+
+    def keys(self):
+        return self._params.keys()
+
+    def items(self):
+        return self._params.items()
+
+    # Values for command and message templates: every alert and summary
+    # parameter, empty if it was not sent, and time which is when the alert
+    # was received unless it was passed along as a parameter. Built once per
+    # alert and returned as a read-only view.
+    def context(self):
+        if self._context is None:
+            context = dict(
+                (param, u'') for param in ALERT_PARAMS + SUMMARY_PARAMS
+            )
+            context['time'] = datetime.fromtimestamp(self.received)
+            context.update(self._params)
+            object.__setattr__(self, '_context', context)
+        return MappingProxyType(self._context)
+
+    def __repr__(self):
+        return 'Alert({params!r})'.format(params=self._params)
@@ -0,0 +1,112 @@
+# Circuit breaker for plugins that keep failing or timing out.
+#
+# The breaker opens after max_failures failures within window seconds. While
+# open the plugin is skipped, after cooldown seconds one call is let through
+# half-open as a probe. A successful probe closes the breaker, a failed one
+# opens it again for another cooldown.
+
+import time
+import threading
+from collections import deque
+from logging import getLogger
+
+l = getLogger('ecs')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, max_failures=5, window=60, cooldown=30):
+        self.name = name
+        self.max_failures = max_failures
+        self.window = window
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = deque()
+        self.opened = None
+        self.probing = False
+        self.lock = threading.Lock()
+        self.skipped = 0
+
+    def status(self):
+        return {
+            'state': self.state,
+            'failures': len(self.failures),
+            'opened': self.opened,
+            'skipped': self.skipped
+        }
+
+    # Returns True if a call may go through
+    def allow(self):
+        if not self.max_failures:
+            return True
+
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+
+            if (self.state == OPEN and
+                    time.time() - self.opened >= self.cooldown):
+                l.warning('{name}: Circuit breaker half-open, probing'.format(
+                    name=self.name
+                ))
+                self.state = HALF_OPEN
+                self.probing = False
+
+            # Only one probe at a time while half-open
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+
+            self.skipped += 1
+            return False
+
+    def success(self):
+        if self.state == CLOSED:
+            return
+
+        with self.lock:
+            if self.state == HALF_OPEN:
+                l.warning('{name}: Circuit breaker closed'.format(
+                    name=self.name
+                ))
+                self.state = CLOSED
+                self.failures.clear()
+                self.opened = None
+                self.probing = False
+
+    def failure(self):
+        if not self.max_failures:
+            return
+
+        now = time.time()
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self._open(now, 'a failed probe')
+                return
+
+            # Calls that were already running when the breaker opened
+            if self.state == OPEN:
+                return
+
+            self.failures.append(now)
+            while self.failures and self.failures[0] <= now - self.window:
+                self.failures.popleft()
+
+            if len(self.failures) >= self.max_failures:
+                self._open(now, '{failures} failures'.format(
+                    failures=len(self.failures)
+                ))
+
+    def _open(self, now, reason):
+        l.warning('{name}: Circuit breaker open for {cooldown}s after {reason}'.format(
+            name=self.name,
+            cooldown=self.cooldown,
+            reason=reason
+        ))
+        self.state = OPEN
+        self.opened = now
+        self.probing = False
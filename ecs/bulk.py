@@ -0,0 +1,119 @@
+# Incremental parser for bulk alert uploads.
+#
+# The body is either a JSON array of alert objects or a stream of objects
+# separated by whitespace or newlines (NDJSON). It is read and decoded in
+# chunks so only the records not yet consumed are held in memory.
+
+import codecs
+import json
+
+WHITESPACE = ' \t\r\n'
+# Characters that can continue a number
+NUMBER = '0123456789.eE+-'
+
+
+class BulkParseError(ValueError):
+    pass
+
+
+class BulkReader(object):
+
+    def __init__(self, stream, chunk_size=65536, max_record_bytes=1048576):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_record_bytes = max_record_bytes
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    # Read the next chunk, dropping the text that has been consumed
+    def _read(self):
+        chunk = self.stream.read(self.chunk_size)
+        self.eof = not chunk
+        self.buf = self.buf[self.pos:] + self.text_decoder.decode(
+            chunk or b'',
+            final=self.eof
+        )
+        self.pos = 0
+
+    def _skip_whitespace(self):
+        while True:
+            while (self.pos < len(self.buf) and
+                    self.buf[self.pos] in WHITESPACE):
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return
+            self._read()
+
+    # Decode the JSON value at the current position
+    def _decode(self):
+        while True:
+            try:
+                record, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError as e:
+                if self.eof:
+                    raise BulkParseError('Invalid JSON: {error}'.format(
+                        error=str(e)
+                    ))
+                self._read_more()
+                continue
+
+            # A number cut off at the end of a chunk, like 3. of 3.5, decodes
+            # as a shorter number. Only trust a value that is followed by
+            # something that can not continue it.
+            if not self.eof and self._cut_off(end):
+                self._read_more()
+                continue
+
+            self.pos = end
+            return record
+
+    def _read_more(self):
+        if len(self.buf) - self.pos > self.max_record_bytes:
+            raise BulkParseError('Record larger than {size} bytes'.format(
+                size=self.max_record_bytes
+            ))
+        self._read()
+
+    # True if only number characters follow end up to the end of the buffer
+    def _cut_off(self, end):
+        while end < len(self.buf) and self.buf[end] in NUMBER:
+            end += 1
+        return end == len(self.buf)
+
+    def __iter__(self):
+        self._skip_whitespace()
+        if self.pos >= len(self.buf):
+            return
+
+        if self.buf[self.pos] != '[':
+            while self.pos < len(self.buf):
+                yield self._decode()
+                self._skip_whitespace()
+            return
+
+        self.pos += 1
+        first = True
+        while True:
+            self._skip_whitespace()
+            if self.pos >= len(self.buf):
+                raise BulkParseError('Unterminated JSON array')
+
+            if self.buf[self.pos] == ']':
+                self.pos += 1
+                break
+
+            if not first:
+                if self.buf[self.pos] != ',':
+                    raise BulkParseError('Missing comma in JSON array')
+                self.pos += 1
+                self._skip_whitespace()
+
+            yield self._decode()
+            first = False
+
+        self._skip_whitespace()
+        if self.pos < len(self.buf):
+            raise BulkParseError('Data after end of JSON array')
@@ -0,0 +1,68 @@
+# Time bounded cache used to suppress duplicate callbacks.
+#
+# Entries expire window seconds after the first callback was seen, so a
+# retry or burst of the same alert is suppressed while a repeated alert after
+# the window goes through again. The cache holds at most max_entries keys
+# and evicts the oldest first.
+
+import time
+import threading
+from collections import OrderedDict
+
+# Alert parameters that identify a callback
+DEDUP_FIELDS = ('alert', 'monitor', 'device', 'status')
+
+
+def dedup_key(alert):
+    return tuple(alert.get(field, '') for field in DEDUP_FIELDS)
+
+
+class DedupCache(object):
+
+    def __init__(self, window, max_entries=10000):
+        self.window = window
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    # Returns True if the key was seen within the window, otherwise records
+    # it and returns False.
+    def seen(self, key):
+        now = time.time()
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is not None and expires > now:
+                self.hits += 1
+                return True
+
+            self.misses += 1
+            if expires is not None:
+                del self.entries[key]
+            self.entries[key] = now + self.window
+
+            # Entries are in expiry order since they all use the same window
+            while self.entries:
+                oldest, expires = next(iter(self.entries.items()))
+                if expires > now and len(self.entries) <= self.max_entries:
+                    break
+                del self.entries[oldest]
+
+            return False
+
+    # Forget a key so the next callback for it is handled, used when an
+    # alert could not be accepted after all.
+    def forget(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
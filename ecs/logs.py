@@ -0,0 +1,118 @@
+# Logging setup shared by ecsapi.py and tools/dispatch_ms.py.
+#
+# Records are put on a bounded queue by the handler attached to the loggers
+# and written by one listener thread, so a slow syslog socket or a rotating
+# log file never holds up a request. Records that do not fit in the queue
+# are dropped and counted. The listener is started again in a forked child
+# the first time the child logs.
+
+import os
+import threading
+from logging import Formatter, getLogger, DEBUG, WARN
+from logging.handlers import SysLogHandler, RotatingFileHandler
+try:
+    from logging.handlers import QueueHandler, QueueListener
+    from queue import Queue, Full
+except ImportError:
+    QueueHandler = None
+
+
+# The handler doing the actual I/O, from the logging section
+def make_handler(config):
+    if config.get('logging', 'log_handler') == 'syslog':
+        syslog_address = config.get('logging', 'syslog_address')
+
+        if syslog_address.startswith('/'):
+            h = SysLogHandler(
+                address=syslog_address,
+                facility=SysLogHandler.LOG_LOCAL0
+            )
+        else:
+            h = SysLogHandler(
+                address=(
+                    config.get('logging', 'syslog_address'),
+                    config.getint('logging', 'syslog_port')
+                ),
+                facility=SysLogHandler.LOG_LOCAL0
+            )
+    else:
+        h = RotatingFileHandler(
+            config.get('logging', 'log_file'),
+            maxBytes=config.getint('logging', 'log_max_bytes'),
+            backupCount=config.getint('logging', 'log_max_copies')
+        )
+    h.setFormatter(Formatter(config.get('logging', 'log_format')))
+    return h
+
+
+if QueueHandler is not None:
+    class BoundedQueueHandler(QueueHandler):
+
+        def __init__(self, target, max_size=10000):
+            QueueHandler.__init__(self, None)
+            self.target = target
+            self.max_size = max_size
+            self.listener = None
+            self.pid = None
+            self.dropped = 0
+            self.start_lock = threading.Lock()
+
+        # Start the listener thread, again in a forked child since threads
+        # do not survive a fork
+        def start(self):
+            with self.start_lock:
+                if self.pid == os.getpid():
+                    return
+                self.queue = Queue(self.max_size)
+                self.listener = QueueListener(
+                    self.queue,
+                    self.target,
+                    respect_handler_level=True
+                )
+                self.listener.start()
+                self.pid = os.getpid()
+
+        def enqueue(self, record):
+            if self.pid != os.getpid():
+                self.start()
+            try:
+                self.queue.put_nowait(record)
+            except Full:
+                self.dropped += 1
+
+        # Write out what is queued, called by logging.shutdown()
+        def close(self):
+            with self.start_lock:
+                if self.listener is not None and self.pid == os.getpid():
+                    try:
+                        self.listener.stop()
+                    except Full:
+                        pass
+                    self.pid = None
+            QueueHandler.close(self)
+
+
+# Set up the ecs logger, or another one, from the logging section. Returns
+# the handler to attach to plugin loggers.
+def setup_logging(config, name='ecs'):
+    target = make_handler(config)
+
+    if QueueHandler is not None:
+        h = BoundedQueueHandler(
+            target,
+            config.getint('logging', 'log_queue_size')
+        )
+        h.start()
+    else:
+        h = target
+
+    l = getLogger(name)
+    if h not in l.handlers:
+        l.addHandler(h)
+
+    if config.getboolean('logging', 'log_debug'):
+        l.setLevel(DEBUG)
+    else:
+        l.setLevel(WARN)
+
+    return h
@@ -0,0 +1,184 @@
+# Counters, histograms and gauges rendered in the Prometheus text format.
+#
+# Every thread updates its own shard of values so the request path never
+# waits on a lock, the shards are only summed when the metrics are scraped.
+
+import bisect
+import threading
+
+# Histogram buckets in seconds
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60
+)
+
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+                '\n', '\\n'
+            )
+        ) for name, value in labels
+    ) + '}'
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.types = {}
+        self.help = {}
+        self.buckets = {}
+        self.gauges = {}
+
+    def counter(self, name, help):
+        self.types[name] = 'counter'
+        self.help[name] = help
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.types[name] = 'histogram'
+        self.help[name] = help
+        self.buckets[name] = tuple(buckets)
+
+    # Gauges are read from a function when the metrics are rendered, the
+    # function returns a number or a list of (labels, number). Counters kept
+    # elsewhere can be exported the same way with metric_type counter.
+    def gauge(self, name, help, function, metric_type='gauge'):
+        self.types[name] = metric_type
+        self.help[name] = help
+        self.gauges[name] = function
+
+    # The calling thread's own dict of values, created on first use
+    def _shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    # Labels are a tuple of (name, value) pairs
+    def inc(self, name, labels=(), amount=1):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        shard = self._shard()
+        key = (name, labels)
+        counts = shard.get(key)
+        if counts is None:
+            # One count per bucket, then +Inf, count and sum
+            counts = shard[key] = [0] * (len(self.buckets[name]) + 2) + [0.0]
+        counts[bisect.bisect_left(self.buckets[name], value)] += 1
+        counts[-2] += 1
+        counts[-1] += value
+
+    # Sum the values of every shard
+    def collect(self):
+        with self.lock:
+            shards = list(self.shards)
+
+        totals = {}
+        for shard in shards:
+            for key, value in list(shard.items()):
+                if isinstance(value, list):
+                    total = totals.get(key)
+                    if total is None:
+                        total = totals[key] = [0] * len(value)
+                    for i, v in enumerate(list(value)):
+                        total[i] += v
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render(self):
+        totals = self.collect()
+        series = {}
+        for (name, labels), value in totals.items():
+            series.setdefault(name, []).append((labels, value))
+
+        for name, function in self.gauges.items():
+            value = function()
+            if isinstance(value, list):
+                series[name] = value
+            else:
+                series[name] = [((), value)]
+
+        lines = []
+        for name in sorted(series):
+            metric_type = self.types.get(name, 'untyped')
+            lines.append('# HELP {0} {1}'.format(name, self.help.get(name, '')))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+
+            for labels, value in sorted(series[name], key=lambda s: s[0]):
+                if metric_type != 'histogram':
+                    lines.append('{0}{1} {2}'.format(
+                        name,
+                        format_labels(labels),
+                        format_value(value)
+                    ))
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(
+                    self.buckets[name] + ('+Inf',),
+                    value[:-2]
+                ):
+                    cumulative += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name,
+                        format_labels(labels, [('le', bound)]),
+                        cumulative
+                    ))
+                lines.append('{0}_sum{1} {2}'.format(
+                    name,
+                    format_labels(labels),
+                    format_value(value[-1])
+                ))
+                lines.append('{0}_count{1} {2}'.format(
+                    name,
+                    format_labels(labels),
+                    value[-2]
+                ))
+
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics shared by everything in the process
+metrics = Metrics()
+
+metrics.counter(
+    'ecs_requests_total',
+    'Callbacks answered by the API, by HTTP status code.'
+)
+metrics.histogram(
+    'ecs_request_duration_seconds',
+    'Time spent answering callbacks.'
+)
+metrics.histogram(
+    'ecs_plugin_duration_seconds',
+    'Time spent handling one alert, by plugin.'
+)
+metrics.counter(
+    'ecs_plugin_exceptions_total',
+    'Exceptions raised while handling alerts, by plugin.'
+)
+metrics.counter(
+    'ecs_dedup_suppressed_total',
+    'Duplicate alerts that were not handled.'
+)
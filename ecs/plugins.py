@@ -0,0 +1,431 @@
+# Plugin registry, finds and configures all plugins once at startup.
+#
+# Plugins are found through entry points. Scanning the installed packages
+# for them is slow so the index can be cached in a file, it is rebuilt when
+# a directory on sys.path changes. Plugin modules are only imported and set
+# up when the first alert reaches them, unless lazy loading is disabled.
+
+import os
+import sys
+import json
+import time
+import threading
+import importlib
+from logging import getLogger, DEBUG, INFO
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:
+    entry_points = None
+
+from ecs.dedup import DedupCache, dedup_key
+from ecs.breaker import CircuitBreaker, CLOSED
+from ecs.workers import CallRunner, CallTimeout
+from ecs.metrics import metrics
+from ecs.profiler import profiler
+from ecs.timing import startup
+
+l = getLogger('ecs')
+
+metrics.counter(
+    'ecs_plugin_timeouts_total',
+    'Plugin calls that ran past their timeout, by plugin.'
+)
+metrics.counter(
+    'ecs_plugin_skipped_total',
+    'Plugin calls skipped by an open circuit breaker, busy runners or the alert deadline.'
+)
+
+
+# Plugin sections can override options of the plugins section
+def plugin_option(config, plugin_name, option, getter='getint'):
+    if config.has_option(plugin_name, option):
+        return getattr(config, getter)(plugin_name, option)
+    return getattr(config, getter)('plugins', option)
+
+
+# Returns [name, value] of every entry point in the group, value is in the
+# form module:attribute.
+def scan_entry_points(group):
+    if entry_points is None:
+        import pkg_resources
+        return [
+            [ep.name, '{0}:{1}'.format(ep.module_name, '.'.join(ep.attrs))]
+            for ep in pkg_resources.iter_entry_points(group)
+        ]
+
+    found = entry_points()
+    if hasattr(found, 'select'):
+        found = found.select(group=group)
+    else:
+        found = found.get(group, [])
+
+    # A package can be found twice, for example as a develop egg-link and in
+    # the working directory
+    seen = set()
+    points = []
+    for ep in found:
+        if ep.name not in seen:
+            seen.add(ep.name)
+            points.append([ep.name, ep.value])
+    return points
+
+
+# Modification times of the sys.path directories, installing or removing a
+# package changes at least one of them.
+def path_signature():
+    signature = []
+    for path in sys.path:
+        try:
+            signature.append([path, os.stat(path or '.').st_mtime])
+        except OSError:
+            signature.append([path, None])
+    return signature
+
+
+# Entry points of the group from the index file if it is still valid,
+# otherwise scan for them and rewrite the index.
+def entry_point_index(group, index_file=None):
+    signature = path_signature()
+    index = {}
+    if index_file:
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            index = {}
+
+        if (index.get('signature') == signature and
+                group in index.get('groups', {})):
+            return index['groups'][group]
+
+    points = scan_entry_points(group)
+
+    if index_file:
+        if index.get('signature') != signature:
+            index = {'signature': signature, 'groups': {}}
+        index['groups'][group] = points
+        try:
+            with open(index_file + '.tmp', 'w') as f:
+                json.dump(index, f)
+            os.rename(index_file + '.tmp', index_file)
+        except (IOError, OSError) as e:
+            l.warning('Could not write plugin index {path}: {error}'.format(
+                path=index_file,
+                error=str(e)
+            ))
+
+    return points
+
+
+# Import module:attribute
+def load_entry_point(value):
+    module_name, _, attrs = value.partition(':')
+    obj = importlib.import_module(module_name.strip())
+    for attr in attrs.strip().split('.'):
+        if attr:
+            obj = getattr(obj, attr)
+    return obj
+
+
+# Minimal stand-in for the bottle request given to legacy plugins, they only
+# ever read request.params.
+class AlertRequest(object):
+
+    def __init__(self, params):
+        self.params = params
+
+
+# Wraps plugins written for the old API where the class is instantiated with
+# the request on every callback and then run() is called.
+class LegacyPlugin(object):
+
+    def __init__(self, plugin_class):
+        self.plugin_class = plugin_class
+
+    def setup(self, config, logging):
+        self.config = config
+        self.l = logging
+
+    def handle(self, alert):
+        inst = self.plugin_class(
+            self.config,
+            self.l,
+            request=AlertRequest(alert)
+        )
+        inst.run()
+
+
+# Imports, instantiates and sets up a plugin the first time it is used. A
+# plugin that fails to load is logged once and skipped from then on.
+class PluginLoader(object):
+
+    def __init__(self, name, value, config, logging):
+        self.name = name
+        self.value = value
+        self.config = config
+        self.l = logging
+        self.inst = None
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.inst is not None or self.failed:
+            return self.inst
+
+        with self.lock:
+            if self.inst is not None or self.failed:
+                return self.inst
+
+            start = time.time()
+            try:
+                plugin_class = load_entry_point(self.value)
+            except Exception as e:
+                l.exception('{plugin} failed to load'.format(
+                    plugin=self.name
+                ))
+                self.failed = True
+                return None
+            imported = time.time()
+            startup.add(
+                '  import {plugin}'.format(plugin=self.name),
+                imported - start
+            )
+
+            if hasattr(plugin_class, 'handle'):
+                inst = plugin_class()
+            else:
+                inst = LegacyPlugin(plugin_class)
+
+            try:
+                inst.setup(self.config, self.l)
+            except Exception as e:
+                l.exception('{plugin} raised exception in setup'.format(
+                    plugin=self.name
+                ))
+                self.failed = True
+                return None
+            startup.add(
+                '  setup {plugin}'.format(plugin=self.name),
+                time.time() - imported
+            )
+
+            self.inst = inst
+            return inst
+
+    def handle(self, alert):
+        inst = self.load()
+        if inst is not None:
+            inst.handle(alert)
+
+
+class PluginRegistry(object):
+
+    def __init__(self, group='ecs.plugins'):
+        self.group = group
+        self.plugins = []
+        self.dedup = {}
+        self.timeouts = {}
+        self.breakers = {}
+        self.deadline = 0
+        self.runners = {}
+
+        metrics.gauge(
+            'ecs_plugin_breaker_open',
+            'Plugins skipped by an open or half-open circuit breaker.',
+            lambda: [
+                ((('plugin', name),), int(breaker.state != CLOSED))
+                for name, breaker in self.breakers.items()
+            ]
+        )
+
+    # Find every plugin in the entry point group and load it, or prepare to
+    # load it on first use when lazy. The handler is attached to each plugin
+    # logger here, and only here.
+    def load(self, config, handler, lazy=None):
+        if lazy is None:
+            lazy = config.getboolean('plugins', 'lazy_load')
+        self.deadline = config.getfloat('plugins', 'deadline')
+
+        # Plugins log at info level unless debugging is enabled
+        plugin_level = INFO
+        if config.getboolean('logging', 'log_debug'):
+            plugin_level = DEBUG
+
+        points = entry_point_index(
+            self.group,
+            config.get('plugins', 'index_file')
+        )
+        startup.step('find plugins')
+
+        for plugin_name, value in points:
+            l.debug('Loading entry point %s', plugin_name)
+
+            plugin_log = getLogger('ecs_'+plugin_name)
+            if handler not in plugin_log.handlers:
+                plugin_log.addHandler(handler)
+            plugin_log.setLevel(plugin_level)
+
+            inst = PluginLoader(plugin_name, value, config, plugin_log)
+            if not lazy and inst.load() is None:
+                continue
+
+            # Plugins can suppress duplicates for longer than the global
+            # window with their own dedup_window
+            if config.has_option(plugin_name, 'dedup_window'):
+                window = config.getint(plugin_name, 'dedup_window')
+                if window:
+                    self.dedup[plugin_name] = DedupCache(
+                        window,
+                        config.getint('dedup', 'max_entries')
+                    )
+
+            self.timeouts[plugin_name] = plugin_option(
+                config,
+                plugin_name,
+                'plugin_timeout',
+                'getfloat'
+            )
+            self.breakers[plugin_name] = CircuitBreaker(
+                plugin_name,
+                max_failures=plugin_option(
+                    config,
+                    plugin_name,
+                    'breaker_failures'
+                ),
+                window=plugin_option(
+                    config,
+                    plugin_name,
+                    'breaker_window',
+                    'getfloat'
+                ),
+                cooldown=plugin_option(
+                    config,
+                    plugin_name,
+                    'breaker_cooldown',
+                    'getfloat'
+                )
+            )
+
+            # Plugins with a timeout run on runner threads of their own so a
+            # hung plugin only holds up its own runners
+            if self.deadline or self.timeouts[plugin_name]:
+                self.runners[plugin_name] = CallRunner(
+                    plugin_option(config, plugin_name, 'runners'),
+                    'ecs-runner-' + plugin_name
+                )
+
+            self.plugins.append((plugin_name, inst))
+
+        return self.plugins
+
+    def status(self):
+        return dict(
+            (plugin_name, dict(
+                self.breakers[plugin_name].status(),
+                timeout=self.timeouts[plugin_name],
+                running=getattr(self.runners.get(plugin_name), 'busy', 0),
+                loaded=inst.inst is not None,
+                failed=inst.failed
+            )) for plugin_name, inst in self.plugins
+        )
+
+    # Run every plugin in order for one alert. Plugins are skipped while
+    # their circuit breaker is open, or once the alert deadline has passed.
+    def handle(self, alert):
+        key = dedup_key(alert)
+        deadline = None
+        if self.deadline:
+            deadline = time.time() + self.deadline
+
+        for plugin_name, inst in self.plugins:
+            if inst.failed:
+                continue
+
+            dedup = self.dedup.get(plugin_name)
+            if dedup is not None and dedup.seen(key):
+                metrics.inc('ecs_dedup_suppressed_total', (
+                    ('plugin', plugin_name),
+                ))
+                l.debug(
+                    '%s: Suppressed duplicate alert %s',
+                    plugin_name,
+                    alert.get('alert', '')
+                )
+                continue
+
+            labels = (('plugin', plugin_name),)
+            timeout = self.timeouts[plugin_name]
+            if deadline is not None:
+                if deadline <= time.time():
+                    metrics.inc('ecs_plugin_skipped_total', labels + (
+                        ('reason', 'deadline'),
+                    ))
+                    l.warning('{plugin}: Skipped alert {alert}, deadline exceeded'.format(
+                        plugin=plugin_name,
+                        alert=alert.get('alert', '')
+                    ))
+                    continue
+
+            breaker = self.breakers[plugin_name]
+            if not breaker.allow():
+                metrics.inc('ecs_plugin_skipped_total', labels + (
+                    ('reason', 'breaker'),
+                ))
+                l.debug(
+                    '%s: Skipped alert %s, circuit breaker open',
+                    plugin_name,
+                    alert.get('alert', '')
+                )
+                continue
+
+            runner = self.runners.get(plugin_name)
+            start = time.time()
+            try:
+                if runner is not None:
+                    runner.call(
+                        profiler.profile,
+                        (plugin_name, inst.handle, alert),
+                        timeout,
+                        deadline
+                    )
+                else:
+                    profiler.profile(plugin_name, inst.handle, alert)
+            except CallTimeout as e:
+                if e.reason == 'busy':
+                    metrics.inc('ecs_plugin_skipped_total', labels + (
+                        ('reason', 'busy'),
+                    ))
+                    l.warning('{plugin}: Skipped alert {alert}, all runners busy'.format(
+                        plugin=plugin_name,
+                        alert=alert.get('alert', '')
+                    ))
+                else:
+                    metrics.inc('ecs_plugin_timeouts_total', labels)
+                    l.error('{plugin}: Alert {alert} timed out after {timeout:.3f}s, {reason}'.format(
+                        plugin=plugin_name,
+                        alert=alert.get('alert', ''),
+                        timeout=time.time() - start,
+                        reason=e.reason
+                    ))
+                # Runners are busy only with the plugin's own calls, but time
+                # spent waiting to start or the shared deadline running out
+                # is not its fault, unless it was probing a half-open breaker
+                if e.reason in ('timeout', 'busy') or breaker.state != CLOSED:
+                    breaker.failure()
+                continue
+            except Exception as e:
+                metrics.inc('ecs_plugin_exceptions_total', labels)
+                l.exception('{plugin} raised exception'.format(
+                    plugin=plugin_name
+                ))
+                breaker.failure()
+                continue
+            else:
+                breaker.success()
+            finally:
+                metrics.observe(
+                    'ecs_plugin_duration_seconds',
+                    time.time() - start,
+                    labels
+                )
@@ -0,0 +1,107 @@
+# Opt-in profiling of callbacks and plugins.
+#
+# When enabled one call in every N for each label is run under cProfile and
+# the stats are written to the profile directory as <label>-<time>.pstats,
+# keeping the newest max_files for each label. Only one call is profiled at
+# a time, others run normally while a profile is being taken.
+
+import os
+import time
+import cProfile
+import itertools
+import threading
+from logging import getLogger
+
+l = getLogger('ecs')
+
+
+class Profiler(object):
+
+    def __init__(self, directory=None, every=100, max_files=20, enabled=False):
+        self.directory = directory
+        self.every = every
+        self.max_files = max_files
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.pending = set()
+
+    # Turn profiling on or off, used by the SIGUSR1 handler
+    def toggle(self, *args):
+        if not self.directory:
+            l.warning('Profiling requested but no profile directory is set')
+            return
+
+        self.enabled = not self.enabled
+        l.warning('Profiling {state}, every {every} calls to {directory}'.format(
+            state='enabled' if self.enabled else 'disabled',
+            every=self.every,
+            directory=self.directory
+        ))
+
+    # Call function with args, profiling it if it is this label's turn
+    def profile(self, label, function, *args):
+        if not self.enabled:
+            return function(*args)
+
+        # A label whose turn came while another profile was running stays
+        # pending until its next call
+        if label not in self.pending:
+            counter = self.counters.get(label)
+            if counter is None:
+                counter = self.counters.setdefault(label, itertools.count())
+            if next(counter) % self.every:
+                return function(*args)
+            self.pending.add(label)
+
+        if not self.lock.acquire(False):
+            return function(*args)
+
+        self.pending.discard(label)
+        try:
+            prof = cProfile.Profile()
+            try:
+                return prof.runcall(function, *args)
+            finally:
+                self.write(label, prof)
+        finally:
+            self.lock.release()
+
+    def write(self, label, prof):
+        safe_label = ''.join(
+            c if c.isalnum() or c in '-_' else '_' for c in label
+        )
+        path = os.path.join(
+            self.directory,
+            '{label}-{time:.6f}.pstats'.format(
+                label=safe_label,
+                time=time.time()
+            )
+        )
+
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            prof.dump_stats(path + '.tmp')
+            os.rename(path + '.tmp', path)
+            self.rotate(safe_label)
+        except (IOError, OSError) as e:
+            l.error('Could not write profile {path}: {error}'.format(
+                path=path,
+                error=str(e)
+            ))
+
+    # Remove the oldest profiles of a label beyond max_files
+    def rotate(self, label):
+        prefix = label + '-'
+        profiles = sorted(
+            f for f in os.listdir(self.directory)
+            if f.startswith(prefix) and f.endswith('.pstats') and
+            f[len(prefix):-len('.pstats')].replace('.', '').isdigit()
+        )
+        for f in profiles[:-self.max_files]:
+            os.unlink(os.path.join(self.directory, f))
+
+
+# Profiler shared by everything in the process
+profiler = Profiler()
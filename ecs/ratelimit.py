@@ -0,0 +1,61 @@
+# Token bucket rate limiting.
+
+import time
+import threading
+
+
+class TokenBucket(object):
+    """Allows rate events per second on average with bursts of up to burst
+    events. A rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    # Must hold the lock
+    def _refill(self, now):
+        self.tokens = min(
+            self.burst,
+            self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    # True if tokens could be taken right now, without taking them
+    def available(self, tokens=1):
+        if not self.rate:
+            return True
+
+        with self.lock:
+            self._refill(time.time())
+            return self.tokens >= tokens
+
+    # Take tokens if available, returns False without waiting otherwise
+    def consume(self, tokens=1):
+        if not self.rate:
+            return True
+
+        with self.lock:
+            self._refill(time.time())
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    # Take tokens, sleeping until enough are available
+    def wait(self, tokens=1):
+        if not self.rate:
+            return
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
@@ -0,0 +1,24 @@
+# Records incoming callbacks to a JSON lines file for tools/replay.py.
+
+import json
+import time
+import threading
+
+
+class Recorder(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.f = open(path, 'a')
+
+    def record(self, params, client):
+        line = json.dumps({
+            'time': time.time(),
+            'client': client,
+            'params': params
+        }, separators=(',', ':')) + '\n'
+
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
@@ -0,0 +1,144 @@
+# Retry scheduler for work that failed and should be tried again later.
+#
+# Failed jobs wait in a heap ordered by when they are due and one thread
+# runs them again, so the number of threads stays the same no matter how
+# many retries are pending. The delay doubles with every attempt up to
+# backoff_max and is jittered so jobs that failed together are not retried
+# together. Jobs that fail max_attempts times are appended to a dead-letter
+# JSON lines file. Pending retries are kept in memory only.
+
+import json
+import time
+import heapq
+import random
+import itertools
+import threading
+from logging import getLogger
+
+l = getLogger('ecs')
+
+
+class RetryScheduler(object):
+    """Calls run(job, attempt) for jobs passed to failed(). A job must have a
+    name attribute and a record() method returning a dict for the dead-letter
+    file.
+    """
+
+    def __init__(self, run, max_attempts=3, backoff=10, backoff_max=300,
+                 dead_letter=None, name='ecs-retry'):
+        self.run = run
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.dead_letter = dead_letter
+        self.name = name
+        self.cond = threading.Condition()
+        self.pending = []
+        self.seq = itertools.count()
+        self.thread = None
+        self.dead_letter_lock = threading.Lock()
+
+        self.retried = 0
+        self.dead = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'retried': self.retried,
+            'dead': self.dead
+        }
+
+    # Seconds to wait before the next attempt, attempt is the one that failed
+    def delay(self, attempt):
+        delay = min(self.backoff_max, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(delay / 2.0, delay)
+
+    # Record a failed attempt of a job. Schedules the next attempt and
+    # returns True, or writes the job to the dead-letter file and returns
+    # False once it has been tried max_attempts times.
+    def failed(self, job, attempt, reason):
+        if attempt >= self.max_attempts:
+            self.dead += 1
+            l.error('{job}: Giving up after {attempts} attempts, {reason}'.format(
+                job=job.name,
+                attempts=attempt,
+                reason=reason
+            ))
+            self.write_dead_letter(job, attempt, reason)
+            return False
+
+        delay = self.delay(attempt)
+        l.warning('{job}: Attempt {attempt} failed, {reason}, retrying in {delay:.1f}s'.format(
+            job=job.name,
+            attempt=attempt,
+            reason=reason,
+            delay=delay
+        ))
+
+        with self.cond:
+            heapq.heappush(self.pending, (
+                time.time() + delay,
+                next(self.seq),
+                job,
+                attempt + 1
+            ))
+
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._work,
+                    name=self.name
+                )
+                self.thread.daemon = True
+                self.thread.start()
+
+            self.cond.notify()
+        return True
+
+    def write_dead_letter(self, job, attempt, reason):
+        if not self.dead_letter:
+            return
+
+        line = json.dumps({
+            'time': time.time(),
+            'attempts': attempt,
+            'reason': reason,
+            'job': job.record()
+        }, separators=(',', ':')) + '\n'
+
+        try:
+            with self.dead_letter_lock:
+                with open(self.dead_letter, 'a') as f:
+                    f.write(line)
+        except (IOError, OSError) as e:
+            l.error('Could not write to dead-letter file {path}: {error}'.format(
+                path=self.dead_letter,
+                error=str(e)
+            ))
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.time()
+                    if self.pending and self.pending[0][0] <= now:
+                        break
+                    if self.pending:
+                        self.cond.wait(self.pending[0][0] - now)
+                    else:
+                        self.cond.wait()
+
+                _, _, job, attempt = heapq.heappop(self.pending)
+                self.retried += 1
+
+            try:
+                self.run(job, attempt)
+            except Exception as e:
+                l.exception('{job}: Retry raised exception'.format(
+                    job=job.name
+                ))
+                self.failed(job, attempt, 'exception: {error}'.format(
+                    error=str(e)
+                ))
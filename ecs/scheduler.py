@@ -0,0 +1,276 @@
+# Priority scheduler for queued alerts, used in place of the FIFO AlertQueue.
+#
+# Each alert gets a priority from the weight of its status times the weight
+# of its monitor type. Alerts are queued per organisation, highest priority
+# first, except that alerts for the same monitor and device always keep
+# their arrival order so a DOWN is never handled after the UP that followed
+# it. The organisations are served with start-time fair queuing: an
+# organisation is charged 1 / (priority * organisation weight) for every
+# alert taken from it, so one organisation with a storm of alerts can not
+# keep the others waiting and DOWN alerts cost less than UP recoveries.
+# Putting and getting an alert is O(log n) in the number of queued alerts.
+# Once the queue is full drop_oldest drops the oldest alert of the
+# organisation with the most queued alerts.
+#
+# Queue items are (spool entry id, alert) like in the AlertQueue.
+
+import heapq
+import threading
+from collections import deque
+
+from ecs.workers import QueueFull, OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST
+
+# Entry fields, an entry is a list so it can be marked as removed
+PRIORITY, SEQ, ITEM, ALIVE = range(4)
+
+
+# Parse weights like "DOWN:4, UP:1" into a dict
+def parse_weights(value, upper=False):
+    weights = {}
+    for pair in value.split(','):
+        if not pair.strip():
+            continue
+        key, sep, weight = pair.rpartition(':')
+        if not sep or not key.strip():
+            raise ValueError('Invalid weight: {pair}'.format(
+                pair=pair.strip()
+            ))
+        if float(weight) <= 0:
+            raise ValueError('Weight must be positive: {pair}'.format(
+                pair=pair.strip()
+            ))
+        key = key.strip()
+        weights[key.upper() if upper else key] = float(weight)
+    return weights
+
+
+# Alerts with the same key are handled in arrival order
+def group_key(alert):
+    return (alert.get('monitor', ''), alert.get('device', ''))
+
+
+class Organisation(object):
+
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = weight
+        # Entries in arrival order per (monitor, device), the first entry of
+        # each is in the heap by priority. Removed entries are left in place
+        # and skipped until there are too many of them.
+        self.groups = {}
+        self.heap = []
+        self.arrivals = deque()
+        self.count = 0
+        self.finish = 0.0
+        self.scheduled = False
+
+
+class AlertScheduler(object):
+
+    def __init__(self, max_size, overflow=OVERFLOW_REJECT,
+                 organisation_max_size=0, status_weights=None,
+                 monitor_type_weights=None, organisation_weights=None):
+        if overflow not in (OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST):
+            raise ValueError('Unknown overflow policy: {overflow}'.format(
+                overflow=overflow
+            ))
+
+        self.max_size = max_size
+        self.overflow = overflow
+        self.organisation_max_size = organisation_max_size
+        self.status_weights = status_weights or {}
+        self.monitor_type_weights = monitor_type_weights or {}
+        self.organisation_weights = organisation_weights or {}
+
+        self.organisations = {}
+        # Organisations with queued alerts by (start tag, seq, name)
+        self.schedule = []
+        self.vtime = 0.0
+        self.seq = 0
+        self.count = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        self.rejected = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.count
+
+    # Queued alerts per organisation
+    def depths(self):
+        with self.cond:
+            return dict(
+                (org.name, org.count) for org in self.organisations.values()
+            )
+
+    def priority(self, alert):
+        return (
+            self.status_weights.get(alert.get('status', '').upper(), 1.0) *
+            self.monitor_type_weights.get(alert.get('monitor_type', ''), 1.0)
+        )
+
+    # Same as AlertQueue.put, the size limits are the total max_size and
+    # organisation_max_size for the organisation of the alert.
+    def put(self, item, force=False):
+        with self.cond:
+            accepted, dropped = self._put(item, force)
+            if not accepted:
+                raise QueueFull
+            self.cond.notify()
+        return dropped
+
+    # Add items while there is room. Returns a list with True for each item
+    # that was added and False for those rejected, and the items dropped to
+    # make room.
+    def put_many(self, items):
+        accepted = []
+        dropped = []
+        with self.cond:
+            for item in items:
+                added, dropped_item = self._put(item)
+                accepted.append(added)
+                if dropped_item is not None:
+                    dropped.append(dropped_item)
+            self.cond.notify_all()
+        return accepted, dropped
+
+    def _put(self, item, force=False):
+        alert = item[1]
+        name = alert.get('organisation', '')
+        org = self.organisations.get(name)
+        if org is None:
+            org = Organisation(
+                name,
+                self.organisation_weights.get(name, 1.0)
+            )
+            self.organisations[name] = org
+
+        dropped = None
+        if not force:
+            if (self.organisation_max_size and
+                    org.count >= self.organisation_max_size):
+                if self.overflow == OVERFLOW_REJECT:
+                    return self._reject(org)
+                dropped = self._drop(org.arrivals)
+            elif self.max_size and self.count >= self.max_size:
+                if self.overflow == OVERFLOW_REJECT:
+                    return self._reject(org)
+                largest = max(
+                    self.organisations.values(),
+                    key=lambda other: other.count
+                )
+                dropped = self._drop(largest.arrivals)
+
+        self.seq += 1
+        entry = [-self.priority(alert), self.seq, item, True]
+        key = group_key(alert)
+        group = org.groups.get(key)
+        if group is None:
+            group = org.groups[key] = deque()
+            heapq.heappush(org.heap, entry)
+        group.append(entry)
+        org.arrivals.append(entry)
+        org.count += 1
+        self.count += 1
+
+        if not org.scheduled:
+            self._schedule(org)
+        return True, dropped
+
+    def _reject(self, org):
+        self.rejected += 1
+        if not org.count and not org.scheduled:
+            del self.organisations[org.name]
+        return False, None
+
+    # Remove the oldest queued entry from arrivals
+    def _drop(self, arrivals):
+        while not arrivals[0][ALIVE]:
+            arrivals.popleft()
+        entry = arrivals.popleft()
+        self._remove(entry)
+        self.dropped += 1
+        return entry[ITEM]
+
+    def _remove(self, entry):
+        entry[ALIVE] = False
+        org = self.organisations[entry[ITEM][1].get('organisation', '')]
+        org.count -= 1
+        self.count -= 1
+        self._compact(org)
+
+    # Drop removed entries once they outnumber the queued ones, this keeps
+    # memory bounded and the cost of skipping them amortized O(1). Every
+    # entry stays in arrivals until it is compacted or dropped.
+    def _compact(self, org):
+        if len(org.arrivals) <= 2 * org.count + 32:
+            return
+
+        org.arrivals = deque(entry for entry in org.arrivals if entry[ALIVE])
+        org.groups = {}
+        for entry in org.arrivals:
+            org.groups.setdefault(group_key(entry[ITEM][1]), deque()).append(
+                entry
+            )
+        org.heap = [group[0] for group in org.groups.values()]
+        heapq.heapify(org.heap)
+
+    def _schedule(self, org):
+        self.seq += 1
+        heapq.heappush(
+            self.schedule,
+            (max(self.vtime, org.finish), self.seq, org.name)
+        )
+        org.scheduled = True
+
+    # Wait for the next item, returns None once the queue is closed and empty.
+    def get(self):
+        with self.cond:
+            while True:
+                while not self.count:
+                    if self.closed:
+                        return None
+                    self.cond.wait()
+
+                start, seq, name = heapq.heappop(self.schedule)
+                org = self.organisations[name]
+                org.scheduled = False
+
+                entry = None
+                while org.heap:
+                    entry = heapq.heappop(org.heap)
+                    self._advance(org, entry)
+                    if entry[ALIVE]:
+                        break
+                    entry = None
+
+                if entry is not None:
+                    self.vtime = start
+                    org.finish = start + 1.0 / (-entry[PRIORITY] * org.weight)
+                    self._remove(entry)
+
+                if org.count:
+                    self._schedule(org)
+                else:
+                    del self.organisations[name]
+
+                if entry is not None:
+                    return entry[ITEM]
+
+    # Take the first entry of its group and put the next queued entry of the
+    # group in the heap
+    def _advance(self, org, entry):
+        key = group_key(entry[ITEM][1])
+        group = org.groups[key]
+        group.popleft()
+        while group and not group[0][ALIVE]:
+            group.popleft()
+        if group:
+            heapq.heappush(org.heap, group[0])
+        else:
+            del org.groups[key]
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
@@ -0,0 +1,276 @@
+# Prefork WSGI server for running the API in production.
+#
+# The master process opens the listen socket and forks worker processes that
+# inherit it. Each worker sets up the app after forking and answers requests
+# on a pool of threads. Workers are replaced when they exit, for example
+# after max_requests requests. SIGTERM or SIGINT to the master stops the
+# workers gracefully, SIGHUP gracefully replaces them with new workers one
+# at a time, so the others keep accepting connections, and SIGUSR1 is passed
+# on to the workers.
+
+import os
+import time
+import errno
+import signal
+import socket
+import logging
+import threading
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from logging import getLogger
+
+from ecs.workers import AlertQueue, WorkerPool
+
+l = getLogger('ecs')
+
+
+class RequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        l.debug('%s %s', self.client_address[0], format % args)
+
+
+# WSGI server on an inherited socket that hands accepted connections to a
+# pool of threads. The accept loop waits while every thread is busy so the
+# other worker processes accept new connections meanwhile.
+class PooledWSGIServer(WSGIServer):
+
+    def __init__(self, sock, app, threads, max_requests):
+        WSGIServer.__init__(
+            self,
+            sock.getsockname()[:2],
+            RequestHandler,
+            bind_and_activate=False
+        )
+        self.socket.close()
+        self.socket = sock
+
+        host, port = sock.getsockname()[:2]
+        self.server_name = host
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(app)
+
+        self.max_requests = max_requests
+        self.requests = 0
+        self.stopping = False
+        self.slots = threading.Semaphore(threads)
+        self.queue = AlertQueue(0)
+        self.pool = WorkerPool(self.queue, self._handle, threads, 'ecs-http')
+        self.pool.start()
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.queue.put((request, client_address))
+
+        self.requests += 1
+        if self.max_requests and self.requests >= self.max_requests:
+            l.info('Worker {pid} served {count} requests, recycling'.format(
+                pid=os.getpid(),
+                count=self.requests
+            ))
+            self.stop()
+
+    def _handle(self, item):
+        request, client_address = item
+        try:
+            self.finish_request(request, client_address)
+        except Exception as e:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def handle_error(self, request, client_address):
+        l.exception('Error handling request from {client}'.format(
+            client=client_address[0]
+        ))
+
+    # Stop accepting connections, serve_forever returns soon after
+    def stop(self, *args):
+        if self.stopping:
+            return
+        self.stopping = True
+        t = threading.Thread(target=self.shutdown)
+        t.daemon = True
+        t.start()
+
+    # Wait for requests that are being handled
+    def drain(self, timeout=None):
+        self.pool.stop(timeout)
+
+    # The listen socket is shared with the other workers, never close it
+    def server_close(self):
+        pass
+
+
+class PreforkServer(object):
+
+    def __init__(self, app_factory, shutdown, host, port, processes=4,
+                 threads=8, max_requests=0, graceful_timeout=30,
+                 backlog=128):
+        self.app_factory = app_factory
+        self.shutdown = shutdown
+        self.host = host
+        self.port = port
+        self.processes = processes
+        self.threads = threads
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.workers = {}
+        # Pids of workers still to be replaced after SIGHUP, in order
+        self.replacing = []
+        self.stopping = False
+
+    def run(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(self.backlog)
+        # Every worker waits for connections on the socket, the ones that
+        # lose the race for a connection must not block in accept()
+        self.sock.setblocking(False)
+
+        l.info('Listening on {host}:{port} with {processes} processes of {threads} threads'.format(
+            host=self.host,
+            port=self.port,
+            processes=self.processes,
+            threads=self.threads
+        ))
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        signal.signal(
+            signal.SIGUSR1,
+            lambda signum, frame: self.signal_workers(signal.SIGUSR1)
+        )
+
+        for worker in range(self.processes):
+            self.spawn(worker)
+
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+
+            if not self.stopping:
+                # Avoid a fork loop if workers die right after starting
+                if os.WIFSIGNALED(status) or os.WEXITSTATUS(status):
+                    l.error('Worker {worker} exited with status {status}'.format(
+                        worker=worker,
+                        status=status
+                    ))
+                    time.sleep(1)
+                self.spawn(worker)
+
+                if self.replacing and self.replacing[0] == pid:
+                    self.replacing.pop(0)
+                    self._replace_next()
+
+        self.sock.close()
+        l.info('All workers stopped')
+
+    def spawn(self, worker):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = worker
+            return
+
+        code = 0
+        try:
+            self.serve(worker)
+        except Exception as e:
+            l.exception('Worker {worker} failed'.format(worker=worker))
+            code = 1
+        finally:
+            # Write out queued log records, os._exit skips atexit handlers
+            logging.shutdown()
+            os._exit(code)
+
+    # Runs in the worker process
+    def serve(self, worker):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        app = self.app_factory(worker)
+        server = PooledWSGIServer(
+            self.sock,
+            app,
+            self.threads,
+            self.max_requests
+        )
+        signal.signal(signal.SIGTERM, server.stop)
+
+        l.debug('Worker %s started with pid %s', worker, os.getpid())
+        server.serve_forever(poll_interval=0.5)
+
+        deadline = time.time() + self.graceful_timeout
+        server.drain(self.graceful_timeout)
+        self.shutdown(max(0, deadline - time.time()))
+        l.debug('Worker %s stopped', worker)
+
+    def _stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+
+        l.info('Stopping workers')
+        self.signal_workers(signal.SIGTERM)
+
+        # Kill what is left after the graceful timeout
+        t = threading.Timer(
+            self.graceful_timeout + 5,
+            self.signal_workers,
+            [signal.SIGKILL]
+        )
+        t.daemon = True
+        t.start()
+
+    # Workers share their spool by worker number, so a new worker can only
+    # start once the one it replaces has stopped. Replacing them one at a
+    # time leaves the other workers accepting connections meanwhile.
+    def _reload(self, signum, frame):
+        if self.stopping:
+            return
+
+        l.info('Replacing workers')
+        idle = not self.replacing
+        self.replacing.extend(
+            pid for pid in self.workers if pid not in self.replacing
+        )
+        if idle:
+            self._replace_next()
+
+    # Stop the next worker to be replaced, the run loop starts its
+    # replacement when it exits
+    def _replace_next(self):
+        while self.replacing:
+            pid = self.replacing[0]
+            if pid in self.workers:
+                l.debug('Replacing worker %s', self.workers[pid])
+                self.signal_worker(pid, signal.SIGTERM)
+                return
+            self.replacing.pop(0)
+
+    def signal_workers(self, signum):
+        for pid in list(self.workers):
+            self.signal_worker(pid, signum)
+
+    def signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
@@ -0,0 +1,255 @@
+# Durable on-disk journal of accepted alerts.
+#
+# Alerts are appended to segment files as JSON lines and a single flusher
+# thread syncs them to disk in groups, every writer waiting for the group
+# commit that covers its record. Handled alerts get a done marker and
+# segments are deleted oldest first once nothing in them is pending. On open
+# the pending entries are copied to a new segment and the old segments are
+# deleted, so restarts do not leave segments behind.
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from logging import getLogger
+
+l = getLogger('ecs')
+
+SEGMENT_SUFFIX = '.seg'
+
+
+class Spool(object):
+
+    def __init__(self, directory, commit_interval=0.01,
+                 segment_max_bytes=4194304, compact_interval=60):
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.segment_max_bytes = segment_max_bytes
+        self.compact_interval = compact_interval
+
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.next_id = 1
+        self.written_seq = 0
+        self.synced_seq = 0
+
+        # Number of pending entries per segment, oldest segment first
+        self.segments = OrderedDict()
+        # Segment of every pending entry
+        self.pending = {}
+
+        self.segment = None
+        self.segment_file = None
+        self.segment_bytes = 0
+        self.closed = False
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, '{0:08d}{1}'.format(
+            segment,
+            SEGMENT_SUFFIX
+        ))
+
+    # Read existing segments and return the pending (id, alert) entries in
+    # the order they were accepted. The entries are written to a new segment
+    # for writing and the old segments deleted once it is synced.
+    def open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+
+        entries = OrderedDict()
+        for segment in segments:
+            with open(self._segment_path(segment)) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write from a crash, nothing after it was synced
+                        l.warning('Skipping corrupt record in segment {segment}'.format(
+                            segment=segment
+                        ))
+                        continue
+
+                    if 'done' in record:
+                        entries.pop(record['done'], None)
+                    else:
+                        entries[record['id']] = record['alert']
+                        self.next_id = max(self.next_id, record['id'] + 1)
+
+        replay = list(entries.items())
+        if replay:
+            l.info('Replaying {count} unfinished alerts from spool'.format(
+                count=len(replay)
+            ))
+
+        with self.lock:
+            self._rotate(segments[-1] + 1 if segments else 1)
+            for entry_id, alert in replay:
+                if self.segment_bytes >= self.segment_max_bytes:
+                    self._rotate(self.segment + 1)
+                self._write({'id': entry_id, 'alert': alert})
+                self.pending[entry_id] = self.segment
+                self.segments[self.segment] += 1
+            self.segment_file.flush()
+            os.fsync(self.segment_file.fileno())
+            self.synced_seq = self.written_seq
+
+        # Everything still pending is in the new segments now
+        for segment in segments:
+            os.remove(self._segment_path(segment))
+
+        t = threading.Thread(target=self._flusher, name='ecs-spool')
+        t.daemon = True
+        t.start()
+
+        return replay
+
+    # Must hold the lock
+    def _rotate(self, segment):
+        if self.segment_file is not None:
+            self.segment_file.flush()
+            os.fsync(self.segment_file.fileno())
+            self.segment_file.close()
+            self.synced_seq = self.written_seq
+            self.synced.notify_all()
+
+        self.segment = segment
+        self.segments[segment] = 0
+        self.segment_file = open(self._segment_path(segment), 'a')
+        self.segment_bytes = 0
+
+    # Must hold the lock
+    def _write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        self.segment_file.write(line)
+        self.segment_bytes += len(line)
+        self.written_seq += 1
+
+    # Journal an alert and return its entry id once it is synced to disk.
+    def append(self, alert):
+        return self.append_many([alert])[0]
+
+    # Journal several alerts with one sync and return their entry ids.
+    def append_many(self, alerts):
+        entry_ids = []
+        with self.lock:
+            for alert in alerts:
+                entry_id = self.next_id
+                self.next_id += 1
+
+                if self.segment_bytes >= self.segment_max_bytes:
+                    self._rotate(self.segment + 1)
+
+                self._write({'id': entry_id, 'alert': alert})
+                self.pending[entry_id] = self.segment
+                self.segments[self.segment] += 1
+                entry_ids.append(entry_id)
+
+            if not self.commit_interval:
+                self.segment_file.flush()
+                os.fsync(self.segment_file.fileno())
+                self.synced_seq = self.written_seq
+            else:
+                seq = self.written_seq
+                while self.synced_seq < seq:
+                    self.synced.wait()
+
+        return entry_ids
+
+    # Mark an entry as handled, it is not synced on its own since replaying
+    # a handled alert after a crash is harmless compared to losing one.
+    def done(self, entry_id):
+        with self.lock:
+            # Entries finished after close are replayed on the next start
+            if self.closed:
+                return
+
+            segment = self.pending.pop(entry_id, None)
+            if segment is None:
+                return
+
+            self._write({'done': entry_id})
+            self.segments[segment] -= 1
+
+    def __len__(self):
+        return len(self.pending)
+
+    # Sync and close the current segment, stop the flusher and delete the
+    # segments nothing is pending in
+    def close(self):
+        with self.lock:
+            if self.closed or self.segment_file is None:
+                return
+
+            self.segment_file.flush()
+            os.fsync(self.segment_file.fileno())
+            self.segment_file.close()
+            self.segment_file = None
+            self.closed = True
+            self.synced_seq = self.written_seq
+            self.synced.notify_all()
+
+        try:
+            self.compact()
+        except Exception as e:
+            l.exception('Spool compaction failed')
+
+    # Group commit loop, also runs compaction every compact_interval.
+    def _flusher(self):
+        last_compact = time.time()
+        while True:
+            time.sleep(self.commit_interval or 1)
+
+            with self.lock:
+                if self.closed:
+                    return
+
+                seq = self.written_seq
+                if seq == self.synced_seq:
+                    fd = None
+                else:
+                    self.segment_file.flush()
+                    fd = os.dup(self.segment_file.fileno())
+
+            # Sync outside the lock so writers can keep appending meanwhile
+            if fd is not None:
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+                with self.lock:
+                    self.synced_seq = max(self.synced_seq, seq)
+                    self.synced.notify_all()
+
+            if time.time() - last_compact >= self.compact_interval:
+                last_compact = time.time()
+                try:
+                    self.compact()
+                except Exception as e:
+                    l.exception('Spool compaction failed')
+
+    # Delete segments from the oldest one as long as nothing in them is
+    # pending. Done markers can refer to entries in older segments so a
+    # segment is never deleted while an older one remains.
+    def compact(self):
+        removed = []
+        with self.lock:
+            for segment, count in list(self.segments.items()):
+                # The current segment is still written to until closed
+                if count or (segment == self.segment and not self.closed):
+                    break
+                del self.segments[segment]
+                removed.append(segment)
+
+        for segment in removed:
+            os.remove(self._segment_path(segment))
+
+        if removed:
+            l.debug('Compacted %s spool segments', len(removed))
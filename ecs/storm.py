@@ -0,0 +1,164 @@
+# Storm protection, rate limits per device and per organisation.
+#
+# Every alert takes a token from the bucket of its device and the bucket of
+# its organisation before any plugin runs, only if both have one. Alerts
+# that find a bucket empty are suppressed and counted, and at the end of
+# each summary interval one summary alert per device or organisation is
+# sent through the plugins in their place. Buckets are kept in LRU order
+# and the least recently used are forgotten once there are more than
+# max_keys of them. Buckets are kept per process, in prefork mode every
+# worker process has its own.
+
+import threading
+from collections import OrderedDict
+from logging import getLogger
+
+from ecs.alert import Alert
+from ecs.ratelimit import TokenBucket
+
+l = getLogger('ecs')
+
+LIMITS = ('device', 'organisation')
+
+
+class KeyedLimiter(object):
+    """Token buckets by key, rate 0 means unlimited. Must be used with the
+    lock of the StormGuard held.
+    """
+
+    def __init__(self, rate, burst, max_keys):
+        self.buckets = OrderedDict()
+        self.configure(rate, burst, max_keys)
+
+    def __len__(self):
+        return len(self.buckets)
+
+    # Change the limits, buckets already in use keep their tokens up to the
+    # new burst
+    def configure(self, rate, burst, max_keys):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        if not rate:
+            self.buckets.clear()
+        for bucket in self.buckets.values():
+            bucket.rate = float(rate)
+            bucket.burst = float(burst or max(1, rate))
+            bucket.tokens = min(bucket.tokens, bucket.burst)
+
+    # The bucket of a key, or None when unlimited
+    def bucket(self, key):
+        if not self.rate:
+            return None
+
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            while len(self.buckets) >= self.max_keys:
+                self.buckets.popitem(last=False)
+        self.buckets[key] = bucket
+        return bucket
+
+
+class StormGuard(object):
+
+    def __init__(self, send, interval=60, max_keys=10000):
+        self.send = send
+        self.interval = interval
+        self.max_keys = max_keys
+        self.limiters = dict(
+            (limit, KeyedLimiter(0, 0, max_keys)) for limit in LIMITS
+        )
+        # (limit, key): [suppressed count, last suppressed alert]
+        self.suppressed = {}
+        self.total = dict((limit, 0) for limit in LIMITS)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # Set the rate and burst of a limit, used again when limits are reloaded
+    def configure(self, limit, rate, burst):
+        with self.lock:
+            self.limiters[limit].configure(rate, burst, self.max_keys)
+        l.info('Rate limit per {limit}: {rate}/s, burst {burst}'.format(
+            limit=limit,
+            rate=rate,
+            burst=burst
+        ))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'suppressed': dict(self.total),
+                'pending': len(self.suppressed),
+                'buckets': dict(
+                    (limit, len(limiter))
+                    for limit, limiter in self.limiters.items()
+                )
+            }
+
+    # Returns True if the alert may go on to the plugins, otherwise it is
+    # counted towards the summary for its device or organisation. A token is
+    # only taken once every bucket of the alert has one, so alerts suppressed
+    # by one limit do not use up the others.
+    def allow(self, alert):
+        with self.lock:
+            buckets = []
+            for limit in LIMITS:
+                key = alert.get(limit, '')
+                bucket = self.limiters[limit].bucket(key)
+                if bucket is None or bucket.available():
+                    buckets.append(bucket)
+                    continue
+
+                self.total[limit] += 1
+                summary = self.suppressed.get((limit, key))
+                if summary is not None:
+                    summary[0] += 1
+                    summary[1] = alert
+                elif len(self.suppressed) < self.max_keys:
+                    self.suppressed[(limit, key)] = [1, alert]
+                return False
+
+            for bucket in buckets:
+                if bucket is not None:
+                    bucket.consume()
+        return True
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='ecs-storm')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                l.exception('Failed to send suppressed alert summaries')
+
+    # Send one summary alert for every device and organisation that had
+    # alerts suppressed since the last flush. The summary is the last
+    # suppressed alert with the suppressed count and a summary text added.
+    def flush(self):
+        with self.lock:
+            suppressed, self.suppressed = self.suppressed, {}
+
+        for (limit, key), (count, alert) in suppressed.items():
+            summary = '{count} alerts suppressed for {limit} {key}'.format(
+                count=count,
+                limit=limit,
+                key=key
+            )
+            l.warning(summary)
+
+            params = dict(alert.params)
+            params['suppressed'] = u'{0}'.format(count)
+            params['summary'] = summary
+            self.send(Alert(params))
@@ -0,0 +1,219 @@
+# Shared supervisor for child processes.
+#
+# One reaper thread tracks every running child, enforces timeouts from a heap
+# of deadlines with SIGTERM followed by SIGKILL, and collects exit statuses.
+# The number of threads stays the same no matter how many children run.
+# Input is written to the stdin of a child without blocking, what does not
+# fit in the pipe right away is written by the reaper thread.
+
+import os
+import time
+import fcntl
+import heapq
+import errno
+import itertools
+import threading
+import subprocess
+from logging import getLogger
+
+l = getLogger('ecs')
+
+
+class Child(object):
+
+    def __init__(self, proc, args, timeout, callback):
+        self.proc = proc
+        self.pid = proc.pid
+        self.args = args
+        self.timeout = timeout
+        self.callback = callback
+        self.started = time.time()
+        self.returncode = None
+        self.duration = None
+        self.killed = False
+        self.input = None
+        self.exited = threading.Event()
+
+    # Wait for the child to exit and return its exit code
+    def wait(self):
+        self.exited.wait()
+        return self.returncode
+
+
+class ProcessSupervisor(object):
+
+    def __init__(self, poll_interval=0.05, kill_grace=5):
+        self.poll_interval = poll_interval
+        self.kill_grace = kill_grace
+        self.cond = threading.Condition()
+        self.children = {}
+        self.deadlines = []
+        self.seq = itertools.count()
+        self.thread = None
+
+        self.spawned = 0
+        self.terminated = 0
+        self.killed = 0
+
+    def running(self):
+        return len(self.children)
+
+    def stats(self):
+        return {
+            'running': len(self.children),
+            'spawned': self.spawned,
+            'terminated': self.terminated,
+            'killed': self.killed
+        }
+
+    # Start a command, write input_data to its stdin and return a Child. The
+    # callback is called with the Child from the reaper thread once it exits.
+    def spawn(self, args, input_data=None, timeout=None, callback=None):
+        proc = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE if input_data else None,
+            universal_newlines=True
+        )
+        child = Child(proc, args, timeout, callback)
+
+        if input_data:
+            fd = proc.stdin.fileno()
+            fcntl.fcntl(
+                fd,
+                fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK
+            )
+            child.input = input_data.encode('utf-8')
+
+        with self.cond:
+            self.children[proc.pid] = child
+            self.spawned += 1
+            if timeout:
+                heapq.heappush(self.deadlines, (
+                    child.started + timeout,
+                    next(self.seq),
+                    child,
+                    False
+                ))
+
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._reap,
+                    name='ecs-supervisor'
+                )
+                self.thread.daemon = True
+                self.thread.start()
+
+            # The deadline is set, a child that does not read its input is
+            # stopped at the timeout like any other
+            self._feed(child)
+            self.cond.notify()
+
+        return child
+
+    # Write as much pending input as the pipe takes, must hold the lock
+    def _feed(self, child):
+        if child.input is None:
+            return
+
+        try:
+            while child.input:
+                written = os.write(child.proc.stdin.fileno(), child.input)
+                child.input = child.input[written:]
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            if e.errno != errno.EPIPE:
+                l.error('Process {pid} input failed: {error}'.format(
+                    pid=child.pid,
+                    error=str(e)
+                ))
+        self._close_input(child)
+
+    def _close_input(self, child):
+        child.input = None
+        try:
+            child.proc.stdin.close()
+        except (IOError, OSError) as e:
+            pass
+
+    def _signal(self, child, kill):
+        try:
+            if kill:
+                child.proc.kill()
+                self.killed += 1
+            else:
+                child.proc.terminate()
+                self.terminated += 1
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _reap(self):
+        while True:
+            exited = []
+            with self.cond:
+                while not self.children:
+                    self.cond.wait()
+
+                now = time.time()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    _, _, child, kill = heapq.heappop(self.deadlines)
+                    if child.pid not in self.children:
+                        continue
+
+                    l.error('Process {pid} taking too long, {action}'.format(
+                        pid=child.pid,
+                        action='killing' if kill else 'terminating'
+                    ))
+                    child.killed = True
+                    self._signal(child, kill)
+
+                    if not kill:
+                        heapq.heappush(self.deadlines, (
+                            now + self.kill_grace,
+                            next(self.seq),
+                            child,
+                            True
+                        ))
+
+                for pid, child in list(self.children.items()):
+                    self._feed(child)
+                    returncode = child.proc.poll()
+                    if returncode is None:
+                        continue
+
+                    if child.input is not None:
+                        self._close_input(child)
+                    del self.children[pid]
+                    child.returncode = returncode
+                    child.duration = now - child.started
+                    exited.append(child)
+
+                # Drop deadlines of children that have exited
+                if not self.children:
+                    self.deadlines = []
+
+            for child in exited:
+                child.exited.set()
+                if child.callback is not None:
+                    try:
+                        child.callback(child)
+                    except Exception as e:
+                        l.exception('Process {pid} exit callback failed'.format(
+                            pid=child.pid
+                        ))
+
+            with self.cond:
+                timeout = self.poll_interval
+                if self.deadlines:
+                    timeout = max(
+                        0,
+                        min(timeout, self.deadlines[0][0] - time.time())
+                    )
+                if self.children:
+                    self.cond.wait(timeout)
+
+
+# Supervisor shared by everything in the process
+supervisor = ProcessSupervisor()
@@ -0,0 +1,42 @@
+# Records how long each step of starting the API takes, reported with
+# python ecsapi.py --startup-profile.
+
+import time
+import threading
+
+
+class StepTimer(object):
+
+    def __init__(self, started=None):
+        self.started = started or time.time()
+        self.last = self.started
+        self.steps = []
+        self.lock = threading.Lock()
+
+    # Record the time since the previous step under name
+    def step(self, name):
+        with self.lock:
+            now = time.time()
+            self.steps.append((name, now - self.last))
+            self.last = now
+
+    # Record a step timed by the caller, like a lazy plugin import
+    def add(self, name, duration):
+        with self.lock:
+            self.steps.append((name, duration))
+
+    def report(self):
+        lines = [
+            '{duration:9.3f}ms  {name}'.format(
+                name=name,
+                duration=duration * 1000
+            ) for name, duration in self.steps
+        ]
+        lines.append('{duration:9.3f}ms  total'.format(
+            duration=(self.last - self.started) * 1000
+        ))
+        return '\n'.join(lines)
+
+
+# Startup steps of this process
+startup = StepTimer()
@@ -0,0 +1,219 @@
+# Bounded alert queue and the pool of worker threads that runs the plugin
+# chain for queued alerts.
+
+import time
+import threading
+from collections import deque
+from logging import getLogger
+
+l = getLogger('ecs')
+
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+
+
+class QueueFull(Exception):
+    pass
+
+
+class CallTimeout(Exception):
+
+    def __init__(self, reason='timeout'):
+        Exception.__init__(self, reason)
+        self.reason = reason
+
+
+class AlertQueue(object):
+
+    def __init__(self, max_size, overflow=OVERFLOW_REJECT):
+        if overflow not in (OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST):
+            raise ValueError('Unknown overflow policy: {overflow}'.format(
+                overflow=overflow
+            ))
+
+        self.max_size = max_size
+        self.overflow = overflow
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.rejected = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    # Add an item to the queue. Raises QueueFull if the queue is full and the
+    # overflow policy is reject, otherwise returns the item that was dropped
+    # to make room or None. Forced items ignore the size limit.
+    def put(self, item, force=False):
+        dropped = None
+        with self.cond:
+            if (not force and self.max_size and
+                    len(self.items) >= self.max_size):
+                if self.overflow == OVERFLOW_REJECT:
+                    self.rejected += 1
+                    raise QueueFull
+                dropped = self.items.popleft()
+                self.dropped += 1
+
+            self.items.append(item)
+            self.cond.notify()
+        return dropped
+
+    # Add items in order while there is room. Returns a list with True for
+    # each item that was added and False for those rejected, and the items
+    # dropped to make room.
+    def put_many(self, items):
+        dropped = []
+        with self.cond:
+            for count, item in enumerate(items):
+                if self.max_size and len(self.items) >= self.max_size:
+                    if self.overflow == OVERFLOW_REJECT:
+                        rejected = len(items) - count
+                        self.rejected += rejected
+                        self.cond.notify_all()
+                        return [True] * count + [False] * rejected, dropped
+                    dropped.append(self.items.popleft())
+                    self.dropped += 1
+
+                self.items.append(item)
+            self.cond.notify_all()
+        return [True] * len(items), dropped
+
+    # Wait for the next item, returns None once the queue is closed and empty.
+    def get(self):
+        with self.cond:
+            while not self.items:
+                if self.closed:
+                    return None
+                self.cond.wait()
+            return self.items.popleft()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class WorkerPool(object):
+
+    def __init__(self, queue, handler, workers, name='ecs-worker'):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.name = name
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(
+                target=self._work,
+                name='{0}-{1}'.format(self.name, i)
+            )
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    # Close the queue and wait for the workers to finish what is queued.
+    def stop(self, timeout=None):
+        self.queue.close()
+        for t in self.threads:
+            t.join(timeout)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            try:
+                self.handler(item)
+            except Exception as e:
+                l.exception('Worker failed to handle alert')
+
+
+class Call(object):
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.queued = time.time()
+        self.started = None
+        self.done = threading.Event()
+        self.abandoned = False
+        self.result = None
+        self.error = None
+
+
+# Runs calls on a pool of threads so the caller can stop waiting after a
+# timeout. A call that times out keeps its thread until it returns, once
+# every thread is taken new calls are refused instead of queued. Calls that
+# were abandoned before they started are never run.
+class CallRunner(object):
+
+    def __init__(self, workers, name='ecs-runner'):
+        self.workers = workers
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.queue = AlertQueue(0)
+        self.pool = WorkerPool(self.queue, self._run, workers, name)
+        self.pool.start()
+
+    # Return function(*args) and re-raise exceptions from the function.
+    # Raises CallTimeout with reason busy if every thread is taken, queued
+    # if it waits longer than timeout seconds to start, timeout if it runs
+    # longer than timeout seconds and deadline if the time.time() deadline
+    # passes first.
+    def call(self, function, args, timeout, deadline=None):
+        with self.lock:
+            if self.busy >= self.workers:
+                raise CallTimeout('busy')
+            self.busy += 1
+
+        call = Call(function, args)
+        self.queue.put(call)
+
+        while True:
+            now = time.time()
+            # The timeout counts from when the call started running
+            end = (call.started or call.queued) + timeout if timeout else None
+            if deadline is not None and (end is None or deadline < end):
+                end = deadline
+
+            if call.done.wait(None if end is None else max(0, end - now)):
+                break
+
+            now = time.time()
+            started = call.started
+            if deadline is not None and now >= deadline:
+                reason = 'deadline'
+            elif started is None:
+                reason = 'queued'
+            elif now >= started + timeout:
+                reason = 'timeout'
+            else:
+                # Started while we waited, wait for the rest of its timeout
+                continue
+
+            call.abandoned = True
+            raise CallTimeout(reason)
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _run(self, call):
+        try:
+            if call.abandoned:
+                return
+
+            call.started = time.time()
+            try:
+                call.result = call.function(*call.args)
+            except Exception as e:
+                call.error = e
+            finally:
+                call.done.set()
+        finally:
+            with self.lock:
+                self.busy -= 1
@@ -1,107 +1,588 @@
 # Web API for Monitorscout ECS (Event Callback Server)
 # by Stefan Midjich <swehack@gmail.com>
 
+# Imported first to time the rest of startup
+from ecs.timing import startup
+
 try:
     from configparser import RawConfigParser
 except ImportError:
     from ConfigParser import RawConfigParser
     pass
 
+import os
+import sys
+import time
+import signal
+import threading
 from json import dumps as json_dumps
-from logging import Formatter, getLogger, DEBUG, WARN, INFO
-from logging.handlers import SysLogHandler, RotatingFileHandler
+from logging import getLogger
+
+from bottle import (
+    get, post, run, default_app, debug, request, response, abort, HTTPError
+)
+startup.step('import bottle')
+
+from ecs.plugins import PluginRegistry
+from ecs.workers import AlertQueue, WorkerPool
+from ecs.scheduler import AlertScheduler, parse_weights
+from ecs.spool import Spool
+from ecs.dedup import DedupCache, dedup_key
+from ecs.recorder import Recorder
+from ecs.bulk import BulkReader, BulkParseError
+from ecs.metrics import metrics
+from ecs.profiler import profiler
+from ecs.supervisor import supervisor
+from ecs.server import PreforkServer
+from ecs.logs import setup_logging
+from ecs.alert import Alert, InvalidAlert
+from ecs.storm import StormGuard, LIMITS
+startup.step('import ecs')
+
+# Configuration is found next to this file, not in the working directory
+base_dir = os.path.dirname(os.path.abspath(__file__))
 
-import pkg_resources
-from bottle import get, post, route, run, default_app, debug, request
 
-config = RawConfigParser()
-config.readfp(open('ecs.cfg'))
-config.read([
-    'ecs_local.cfg',
-    '/etc/ecs.cfg'
-])
+def read_config():
+    config = RawConfigParser()
+    with open(os.path.join(base_dir, 'ecs.cfg')) as f:
+        if hasattr(config, 'read_file'):
+            config.read_file(f)
+        else:
+            config.readfp(f)
+    config.read([
+        os.path.join(base_dir, 'ecs_local.cfg'),
+        '/etc/ecs.cfg'
+    ])
+    return config
 
-# Setup logging
-formatter = Formatter(config.get('logging', 'log_format'))
+config = read_config()
+startup.step('read config')
+
+# Setup logging, records are written by a listener thread
+h = setup_logging(config)
 l = getLogger('ecs')
-if config.get('logging', 'log_handler') == 'syslog':
-    syslog_address = config.get('logging', 'syslog_address')
+metrics.gauge(
+    'ecs_log_dropped_total',
+    'Log records dropped because the log queue was full.',
+    lambda: getattr(h, 'dropped', 0),
+    metric_type='counter'
+)
+startup.step('setup logging')
+
+# Parameters that must be present before an alert is accepted
+required_params = [
+    p.strip() for p in config.get('api', 'required_params').split(',')
+    if p.strip()
+]
+
+# Set up by setup_app()
+registry = None
+recorder = None
+dedup = None
+alert_queue = None
+spool = None
+worker_pool = None
+storm = None
+
+
+# Queue items are (spool entry id, alert), the id is None without a spool
+def handle_queued(item):
+    entry_id, alert = item
+    try:
+        registry.handle(alert)
+    finally:
+        if entry_id is not None:
+            spool.done(entry_id)
+
+
+# Load the plugins and start the queue, spool and workers. This runs once
+# per process, in prefork mode in each worker process after it has forked.
+# Each worker process then has its own spool in a numbered subdirectory.
+# With profile_only only the plugins are loaded, nothing is started. Signal
+# handlers are only installed with signals, when ecsapi.py runs the server
+# itself, other WSGI servers have their own. A loaded PluginRegistry can be
+# passed as plugins to use in place of the configured plugins.
+def setup_app(worker=None, lazy=None, profile_only=False, signals=False,
+              plugins=None):
+    global registry, recorder, dedup, alert_queue, spool, worker_pool, storm
+
+    if profile_only:
+        registry = PluginRegistry()
+        registry.load(config, h, lazy=False)
+        startup.step('load plugins')
+        return
+
+    # Profile one callback and plugin call in every N, toggled with SIGUSR1
+    profiler.directory = config.get('profiling', 'directory')
+    profiler.every = config.getint('profiling', 'every')
+    profiler.max_files = config.getint('profiling', 'max_files')
+    profiler.enabled = bool(
+        profiler.directory and config.getboolean('profiling', 'enabled')
+    )
+    if signals:
+        try:
+            signal.signal(signal.SIGUSR1, profiler.toggle)
+        except ValueError:
+            # Signal handlers can only be set from the main thread
+            l.debug('Not in main thread, profiling can not be toggled with SIGUSR1')
+
+    # Find, load and setup all plugins once per process
+    registry = plugins
+    if registry is None:
+        registry = PluginRegistry()
+        registry.load(config, h, lazy=lazy)
+    startup.step('load plugins')
+
+    # Every callback is appended to the record file if one is configured
+    if config.get('api', 'record_file'):
+        recorder = Recorder(config.get('api', 'record_file'))
+
+    # Duplicate callbacks within the window are answered but not handled
+    if config.getint('dedup', 'window'):
+        dedup = DedupCache(
+            config.getint('dedup', 'window'),
+            config.getint('dedup', 'max_entries')
+        )
+
+    # Alerts over the rate limit of their device or organisation are
+    # suppressed and summarized. Prefork workers read the limits from the
+    # config files again when they start, so SIGHUP to the master applies
+    # new limits. The bottle server reloads the limits on SIGHUP, under
+    # other WSGI servers they are read when the app is set up.
+    storm = StormGuard(
+        send_summary,
+        interval=config.getint('ratelimit', 'summary_interval'),
+        max_keys=config.getint('ratelimit', 'max_keys')
+    )
+    configure_limits(config if worker is None else read_config())
+    storm.start()
+    if worker is None and signals:
+        try:
+            signal.signal(signal.SIGHUP, reload_limits)
+        except ValueError:
+            l.debug('Not in main thread, limits can not be reloaded with SIGHUP')
+    metrics.gauge(
+        'ecs_ratelimit_suppressed_total',
+        'Alerts suppressed by the rate limit of their device or organisation.',
+        lambda: [
+            ((('limit', limit),), count)
+            for limit, count in storm.stats()['suppressed'].items()
+        ],
+        metric_type='counter'
+    )
 
-    if syslog_address.startswith('/'):
-        h = SysLogHandler(
-            address=syslog_address,
-            facility=SysLogHandler.LOG_LOCAL0
+    # Accepted alerts are queued and handled by a pool of workers, unless
+    # workers is 0 in which case the plugins run inline in the request.
+    if not config.getint('queue', 'workers'):
+        return
+
+    # Alerts are taken by priority and fairly across organisations, or in
+    # the order they arrived with the fifo scheduler
+    if config.get('queue', 'scheduler') == 'fifo':
+        alert_queue = AlertQueue(
+            config.getint('queue', 'max_size'),
+            overflow=config.get('queue', 'overflow')
         )
     else:
-        h = SysLogHandler(
-            address=(
-                config.get('logging', 'syslog_address'),
-                config.get('logging', 'syslog_port')
+        alert_queue = AlertScheduler(
+            config.getint('queue', 'max_size'),
+            overflow=config.get('queue', 'overflow'),
+            organisation_max_size=config.getint(
+                'queue',
+                'organisation_max_size'
+            ),
+            status_weights=parse_weights(
+                config.get('queue', 'status_weights'),
+                upper=True
             ),
-            facility=SysLogHandler.LOG_LOCAL0
+            monitor_type_weights=parse_weights(
+                config.get('queue', 'monitor_type_weights')
+            ),
+            organisation_weights=parse_weights(
+                config.get('queue', 'organisation_weights')
+            )
         )
-else:
-    h = RotatingFileHandler(
-        config.get('logging', 'log_file'),
-        maxBytes=config.getint('logging', 'log_max_bytes'),
-        backupCount=config.getint('logging', 'log_max_copies')
+
+    # Queued alerts are journaled to disk first if a spool is configured
+    if config.get('spool', 'directory'):
+        spool_directory = config.get('spool', 'directory')
+        if worker is not None:
+            spool_directory = os.path.join(
+                spool_directory,
+                'worker-{0}'.format(worker)
+            )
+
+        spool = Spool(
+            spool_directory,
+            commit_interval=config.getfloat('spool', 'commit_interval'),
+            segment_max_bytes=config.getint('spool', 'segment_max_bytes'),
+            compact_interval=config.getint('spool', 'compact_interval')
+        )
+        for entry_id, record in spool.open():
+            alert_queue.put((entry_id, Alert.loads(record)), force=True)
+        startup.step('replay spool')
+
+    worker_pool = WorkerPool(
+        alert_queue,
+        handle_queued,
+        config.getint('queue', 'workers')
     )
-h.setFormatter(formatter)
-l.addHandler(h)
+    worker_pool.start()
+    startup.step('start workers')
 
-if config.get('logging', 'log_debug'):
-    l.setLevel(DEBUG)
-else:
-    l.setLevel(WARN)
+    metrics.gauge(
+        'ecs_queue_depth',
+        'Alerts waiting in the queue.',
+        lambda: len(alert_queue)
+    )
+    metrics.gauge(
+        'ecs_queue_rejected_total',
+        'Alerts rejected because the queue was full.',
+        lambda: alert_queue.rejected,
+        metric_type='counter'
+    )
+    metrics.gauge(
+        'ecs_queue_dropped_total',
+        'Queued alerts dropped to make room for newer ones.',
+        lambda: alert_queue.dropped,
+        metric_type='counter'
+    )
 
 
-@get(config.get('api', 'url_path'))
-def ecs():
-    l.debug('Received callback from {client_ip}'.format(
-        client_ip=request.remote_route[0]
-    ))
-
-    for entrypoint in pkg_resources.iter_entry_points('ecs.plugins'):
-        # Get plugin class and name from entrypoint
-        l.debug('Loading entry point {point}'.format(
-            point=entrypoint.name
-        ))
-        plugin_class = entrypoint.load()
-        plugin_name = entrypoint.name
+# Set the rate limits from the ratelimit section
+def configure_limits(limits_config):
+    for limit in LIMITS:
+        storm.configure(
+            limit,
+            limits_config.getfloat('ratelimit', '{0}_rate'.format(limit)),
+            limits_config.getint('ratelimit', '{0}_burst'.format(limit))
+        )
+
+
+# SIGHUP handler, a broken config file keeps the limits as they were
+def reload_limits(signum, frame):
+    try:
+        configure_limits(read_config())
+    except Exception as e:
+        l.exception('Failed to reload rate limits')
 
-        # Setup plugin log handler
-        plugin_log = getLogger('ecs_'+plugin_name)
-        plugin_log.addHandler(h)
-        plugin_log.setLevel(DEBUG)
 
-        # Instantiate the class
+# Summaries of suppressed alerts go through the plugins like other alerts
+def send_summary(alert):
+    if alert_queue is None:
+        registry.handle(alert)
+    else:
+        enqueue([alert])
+
+
+# Handle what is left in the queue before the process exits, anything not
+# handled within timeout seconds stays in the spool for the next start.
+def shutdown_app(timeout=None):
+    if storm is not None:
+        storm.stop()
+    if worker_pool is not None:
+        worker_pool.stop(timeout)
+    if spool is not None:
+        spool.close()
+
+
+# Route plugin counting requests by status code and timing them
+def instrumented(callback):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        status = 500
         try:
-            inst = plugin_class(
-                config,
-                plugin_log,
-                request=request
+            body = callback(*args, **kwargs)
+            status = response.status_code
+            return body
+        except HTTPError as e:
+            status = e.status_code
+            raise
+        finally:
+            metrics.inc('ecs_requests_total', (('code', status),))
+            metrics.observe(
+                'ecs_request_duration_seconds',
+                time.time() - start
             )
-        except Exception as e:
-            l.exception('{plugin} raised exception'.format(
-                plugin=plugin_name
-            ))
+    return wrapper
+
+
+# Route plugin profiling one callback in every N when profiling is enabled
+def profiled(callback):
+    def wrapper(*args, **kwargs):
+        return profiler.profile(
+            'request',
+            lambda: callback(*args, **kwargs)
+        )
+    return wrapper
+
+
+def is_duplicate(alert):
+    if dedup is not None and dedup.seen(dedup_key(alert)):
+        l.debug('Suppressed duplicate alert %s', alert.get('alert', ''))
+        return True
+    return False
+
+
+# An alert that was seen but could not be accepted after all, a retry of it
+# must not count as a duplicate
+def forget_duplicate(alert):
+    if dedup is not None:
+        dedup.forget(dedup_key(alert))
+
+
+def is_limited(alert):
+    if storm is not None and not storm.allow(alert):
+        l.debug('Rate limited alert %s', alert.get('alert', ''))
+        return True
+    return False
+
+
+# Journal and queue alerts in one step. Returns a list with True for each
+# alert that was queued and False for those rejected because the queue, or
+# the share of the queue for their organisation, is full.
+def enqueue(alerts):
+    entry_ids = [None] * len(alerts)
+    try:
+        if spool is not None:
+            entry_ids = spool.append_many(
+                [alert.record() for alert in alerts]
+            )
+
+        queued, dropped = alert_queue.put_many(list(zip(entry_ids, alerts)))
+    except Exception as e:
+        for alert in alerts:
+            forget_duplicate(alert)
+        raise
+
+    for entry_id, alert, accepted in zip(entry_ids, alerts, queued):
+        if accepted:
+            continue
+        l.warning('Alert queue full, rejecting alert {alert}'.format(
+            alert=alert.get('alert', '')
+        ))
+        if entry_id is not None:
+            spool.done(entry_id)
+        forget_duplicate(alert)
+
+    for dropped_id, dropped_alert in dropped:
+        l.warning('Alert queue full, dropped oldest alert {alert}'.format(
+            alert=dropped_alert.get('alert', '')
+        ))
+        if dropped_id is not None:
+            spool.done(dropped_id)
+
+    return queued
+
+
+@get(config.get('api', 'url_path'), apply=[instrumented, profiled])
+def ecs():
+    l.debug('Received callback from %s', request.remote_route[0])
+
+    if recorder is not None:
+        recorder.record(dict(request.params.items()), request.remote_route[0])
+
+    try:
+        alert = Alert.from_params(request.params, required_params)
+    except InvalidAlert as e:
+        abort(400, str(e))
+
+    if is_duplicate(alert) or is_limited(alert):
+        if alert_queue is not None:
+            response.status = 202
+        return
+
+    if alert_queue is None:
+        registry.handle(alert)
+        return
+
+    if not enqueue([alert])[0]:
+        abort(503, 'Alert queue full')
+
+    response.status = 202
+
+
+# Validate, journal and queue one batch of bulk records, adding a result for
+# each record.
+def handle_bulk_batch(batch, results):
+    accepted = []
+    for index, record in batch:
+        result = {'index': index}
+        results.append(result)
+        if not isinstance(record, dict):
+            result.update(status='invalid', error='Record is not an object')
             continue
 
-        # Run plugin
         try:
-            inst.run()
-        except Exception as e:
-            l.exception('{plugin} raised exception'.format(
-                plugin=plugin_name
-            ))
+            alert = Alert.from_params(record)
+        except InvalidAlert as e:
+            result.update(status='invalid', error=str(e))
             continue
 
+        result['alert'] = alert.get('alert', '')
+        if recorder is not None:
+            recorder.record(dict(alert.params), request.remote_route[0])
+
+        missing = alert.missing(required_params)
+        if missing:
+            result.update(
+                status='invalid',
+                error='Missing parameters: {params}'.format(
+                    params=', '.join(missing)
+                )
+            )
+        elif is_duplicate(alert):
+            result['status'] = 'duplicate'
+        else:
+            accepted.append((alert, result))
+
+    if not accepted:
+        return
+
+    if alert_queue is None:
+        for alert, result in accepted:
+            registry.handle(alert)
+            result['status'] = 'handled'
+        return
+
+    queued = enqueue([alert for alert, result in accepted])
+    for (alert, result), was_queued in zip(accepted, queued):
+        if was_queued:
+            result['status'] = 'queued'
+        else:
+            result.update(status='rejected', error='Alert queue full')
+
+
+if config.get('api', 'bulk_path'):
+    @post(config.get('api', 'bulk_path'), apply=[instrumented, profiled])
+    def ecs_bulk():
+        l.debug('Received bulk upload from %s', request.remote_route[0])
+
+        batch_size = config.getint('bulk', 'batch_size')
+        max_records = config.getint('bulk', 'max_records')
+        results = []
+        batch = []
+        error = None
+
+        try:
+            for index, record in enumerate(BulkReader(
+                    request.body,
+                    max_record_bytes=config.getint('bulk', 'max_record_bytes'))):
+                if max_records and index >= max_records:
+                    raise BulkParseError('More than {count} records'.format(
+                        count=max_records
+                    ))
+
+                batch.append((index, record))
+                if len(batch) >= batch_size:
+                    handle_bulk_batch(batch, results)
+                    batch = []
+        except BulkParseError as e:
+            error = str(e)
+
+        if batch:
+            handle_bulk_batch(batch, results)
+
+        counts = {}
+        for result in results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+
+        body = {'counts': counts, 'results': results}
+        if error:
+            l.warning('Bulk upload from {client_ip} stopped: {error}'.format(
+                client_ip=request.remote_route[0],
+                error=error
+            ))
+            body['error'] = error
+            response.status = 400
+        elif alert_queue is not None:
+            response.status = 202
+
+        response.content_type = 'application/json'
+        return json_dumps(body)
+
+
+if config.get('metrics', 'path'):
+    @get(config.get('metrics', 'path'))
+    def ecs_metrics():
+        response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        return metrics.render()
+
+
+if config.get('api', 'status_path'):
+    @get(config.get('api', 'status_path'))
+    def ecs_status():
+        status = {
+            'plugins': registry.status(),
+            'processes': supervisor.stats(),
+            'log_dropped': getattr(h, 'dropped', 0)
+        }
+        if alert_queue is not None:
+            status['queue'] = {
+                'depth': len(alert_queue),
+                'rejected': alert_queue.rejected,
+                'dropped': alert_queue.dropped
+            }
+            if hasattr(alert_queue, 'depths'):
+                status['queue']['organisations'] = alert_queue.depths()
+        if dedup is not None:
+            status['dedup'] = dedup.stats()
+        if storm is not None:
+            status['ratelimit'] = storm.stats()
+
+        response.content_type = 'application/json'
+        return json_dumps(status)
+
+
+# Prefork worker processes set up the app themselves once they have forked
+def worker_app(worker):
+    setup_app(worker, signals=True)
+    return default_app()
+
+
+# WSGI application for other servers. Servers can import the module and then
+# fork, so the app is set up by the first request in the process that serves
+# it, where its threads keep running.
+class LazyApplication(object):
+
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    setup_app()
+                    self.pid = os.getpid()
+        return default_app()(environ, start_response)
+
 
 if __name__ == '__main__':
-    run(
-        host=config.get('api', 'host'),
-        port=config.get('api', 'port')
-    )
-    debug(config.get('logging', 'log_debug'))
+    # Load every plugin right away and report how long each step took
+    if '--startup-profile' in sys.argv[1:]:
+        setup_app(profile_only=True)
+        sys.stdout.write(startup.report() + '\n')
+        sys.exit(0)
+
+    if config.getint('api', 'processes'):
+        PreforkServer(
+            worker_app,
+            shutdown_app,
+            host=config.get('api', 'host'),
+            port=config.getint('api', 'port'),
+            processes=config.getint('api', 'processes'),
+            threads=config.getint('api', 'threads'),
+            max_requests=config.getint('api', 'max_requests'),
+            graceful_timeout=config.getint('api', 'graceful_timeout')
+        ).run()
+    else:
+        setup_app(signals=True)
+        run(
+            host=config.get('api', 'host'),
+            port=config.get('api', 'port')
+        )
+        debug(config.get('logging', 'log_debug'))
 else:
-    application = default_app()
+    application = LazyApplication()
@@ -3,12 +3,11 @@
 class LoggingPlugin(object):
     plugin_name = 'LoggingPlugin'
 
-    def __init__(self, config, logging, **kw):
+    def setup(self, config, logging):
         self.l = logging
         self.config = config
-        self.request = kw['request']
 
-    def run(self):
+    def handle(self, alert):
         self.l.info('Request params: {params}'.format(
-            params=self.request.params.keys()
+            params=list(alert.keys())
         ))
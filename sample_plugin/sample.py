@@ -10,19 +10,23 @@ class SamplePlugin(object):
     """
     plugin_name = 'SamplePlugin'
 
-    def __init__(self, config, logging, **kw):
-        """The main plugin class configured as entry_point in setup.py must
-        also have an __init__ method.
+    def setup(self, config, logging):
+        """Plugins are loaded and setup once per process, not on each
+        callback. Anything expensive like parsing configuration belongs here.
 
-        This does not have to do much but takes at least two arguments, with
-        a RawConfigParser object and a logging object.
-
-        The last keyword arguments are optional and not implemented yet.
+        This takes two arguments, a RawConfigParser object and a logging
+        object. Raising an exception here disables the plugin.
         """
         raise NotImplementedError
 
-    def run(self):
-        """This method is run after each plugin is instantiated. It takes no
-        arguments and should instead take class attributes set by __init__.
+    def handle(self, alert):
+        """This method is run once for each callback. It takes the alert
+        as a read-only ecs.alert.Alert, shared with the other plugins, that
+        is read like a dict of the alert parameters. It should use class
+        attributes set by setup().
+
+        Plugins without a handle method are treated as old style plugins,
+        instantiated with __init__(config, logging, request=request) on every
+        callback and then executed with run().
         """
         raise NotImplementedError
@@ -0,0 +1,85 @@
+# Tests for the incremental bulk upload parser.
+
+import os
+import sys
+import json
+import unittest
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ecs.bulk import BulkReader, BulkParseError
+
+
+class BulkReaderTest(unittest.TestCase):
+
+    def read(self, body, **kwargs):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        return list(BulkReader(BytesIO(body), **kwargs))
+
+    # Parse body split into chunks at every possible size
+    def assertChunked(self, body, expected):
+        for chunk_size in range(1, len(body.encode('utf-8')) + 1):
+            self.assertEqual(
+                self.read(body, chunk_size=chunk_size),
+                expected,
+                'chunk_size {0}'.format(chunk_size)
+            )
+
+    def test_array(self):
+        records = [{'alert': str(i), 'status': 'DOWN'} for i in range(3)]
+        self.assertChunked(json.dumps(records), records)
+
+    def test_ndjson(self):
+        records = [{'alert': str(i)} for i in range(3)]
+        self.assertChunked(
+            '\n'.join(json.dumps(r) for r in records) + '\n',
+            records
+        )
+
+    def test_empty(self):
+        self.assertEqual(self.read(''), [])
+        self.assertEqual(self.read(' \n'), [])
+        self.assertEqual(self.read('[]'), [])
+
+    def test_numbers_split_across_chunks(self):
+        self.assertChunked('[3.5, 12, -1e3, {"a": 1}]', [3.5, 12, -1e3, {'a': 1}])
+        self.assertChunked('3.5\n12\n-1e3\n', [3.5, 12, -1e3])
+
+    def test_literals_split_across_chunks(self):
+        self.assertChunked('[true, null, false]', [True, None, False])
+
+    def test_multibyte_text_split_across_chunks(self):
+        records = [{'device_hostname': u'värdén-☃'}]
+        self.assertChunked(json.dumps(records, ensure_ascii=False), records)
+
+    def test_missing_comma(self):
+        with self.assertRaises(BulkParseError):
+            self.read('[{"a": 1} {"a": 2}]')
+
+    def test_unterminated_array(self):
+        with self.assertRaises(BulkParseError):
+            self.read('[{"a": 1},', chunk_size=4)
+
+    def test_data_after_array(self):
+        with self.assertRaises(BulkParseError):
+            self.read('[{"a": 1}] {"a": 2}')
+
+    def test_invalid_json(self):
+        with self.assertRaises(BulkParseError):
+            self.read('{"a": }')
+
+    def test_records_before_error_returned(self):
+        reader = iter(BulkReader(BytesIO(b'{"a": 1}\n{"a": '), chunk_size=4))
+        self.assertEqual(next(reader), {'a': 1})
+        self.assertRaises(BulkParseError, next, reader)
+
+    def test_max_record_bytes(self):
+        body = '[{"a": "' + 'x' * 1000 + '"}]'
+        with self.assertRaises(BulkParseError):
+            self.read(body, chunk_size=64, max_record_bytes=100)
+        self.assertEqual(len(self.read(body, chunk_size=64)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
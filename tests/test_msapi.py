@@ -0,0 +1,221 @@
+# Tests for the MS API client against a local XML-RPC server.
+
+import os
+import sys
+import time
+import socket
+import threading
+import unittest
+try:
+    from configparser import RawConfigParser
+    from socketserver import ThreadingMixIn
+    from xmlrpc.client import Fault
+    from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+except ImportError:
+    from ConfigParser import RawConfigParser
+    from SocketServer import ThreadingMixIn
+    from xmlrpclib import Fault
+    from SimpleXMLRPCServer import (
+        SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+    )
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'tools'
+))
+from msapi import MSSession, MetadataCache
+
+
+class RequestHandler(SimpleXMLRPCRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if self.server.fail_next:
+            self.server.fail_next = False
+            self.send_error(500)
+            return
+
+        SimpleXMLRPCRequestHandler.do_POST(self)
+
+        # Close the connection without telling the client, like a server
+        # dropping an idle keep-alive connection
+        if self.server.drop_connections:
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MSAPIServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+    def __init__(self):
+        SimpleXMLRPCServer.__init__(
+            self,
+            ('127.0.0.1', 0),
+            requestHandler=RequestHandler,
+            allow_none=True,
+            logRequests=False
+        )
+        self.fail_next = False
+        self.drop_connections = False
+        self.sessions = set()
+        self.logins = 0
+        self.calls = {}
+
+        self.register_multicall_functions()
+        self.register_function(self.login, 'login')
+        self.register_function(self.r_get2, 'device.r_get2')
+        self.register_function(self.fails, 'device.fails')
+        self.register_function(self.slow, 'device.slow')
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def login(self, username, password, account):
+        self.logins += 1
+        sid = 'sid{0}'.format(self.logins)
+        self.sessions.add(sid)
+        return sid
+
+    def check(self, sid):
+        if sid not in self.sessions:
+            raise Fault(1, 'Invalid session')
+
+    def r_get2(self, sid, query):
+        self.count('r_get2')
+        self.check(sid)
+        return {
+            'matches': [query['id']],
+            'entity_data': {query['id']: {'id': query['id']}}
+        }
+
+    def fails(self, sid):
+        self.count('fails')
+        self.check(sid)
+        raise Fault(2, 'No such device')
+
+    def slow(self, sid):
+        self.count('slow')
+        time.sleep(1)
+        return True
+
+
+class MSSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MSAPIServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        config = RawConfigParser()
+        config.add_section('DispatchPlugin')
+        for option, value in (
+                ('ms_api_host', '127.0.0.1'),
+                ('ms_api_port', str(self.server.server_address[1])),
+                ('ms_api_username', 'user'),
+                ('ms_api_password', 'password'),
+                ('ms_api_account', 'account'),
+                ('ms_api_read_timeout', '0.3')):
+            config.set('DispatchPlugin', option, value)
+        self.session = MSSession(config)
+
+    def tearDown(self):
+        self.session.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_session_and_connection_reused(self):
+        for device in ('d1', 'd2', 'd3'):
+            result = self.session.call('device.r_get2', {'id': device})
+            self.assertEqual(result['matches'], [device])
+
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(self.session.transport.connections, 1)
+
+    def test_expired_session_logs_in_again(self):
+        self.session.call('device.r_get2', {'id': 'd1'})
+        self.server.sessions.clear()
+
+        self.session.call('device.r_get2', {'id': 'd1'})
+        self.assertEqual(self.server.logins, 2)
+
+    def test_other_fault_raised_without_login(self):
+        self.session.login()
+        with self.assertRaises(Fault):
+            self.session.call('device.fails')
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(self.server.calls['fails'], 1)
+
+    def test_dropped_connection_retried(self):
+        self.session.login()
+        self.server.drop_connections = True
+        self.session.call('device.r_get2', {'id': 'd1'})
+        # Let the server close the connection the client keeps in its pool
+        time.sleep(0.1)
+        self.session.call('device.r_get2', {'id': 'd2'})
+
+        self.assertEqual(self.server.calls['r_get2'], 2)
+        self.assertEqual(self.session.transport.connections, 2)
+
+    def test_read_timeout_not_retried(self):
+        # Fill the pool so the slow call goes out on a reused connection
+        self.session.call('device.r_get2', {'id': 'd1'})
+
+        with self.assertRaises(socket.timeout):
+            self.session.call('device.slow')
+        self.assertEqual(self.server.calls['slow'], 1)
+
+    def test_call_many_batches(self):
+        devices = ['d{0}'.format(i) for i in range(5)]
+        self.session.login()
+        results = self.session.call_many([
+            ('device.r_get2', ({'id': device},)) for device in devices
+        ])
+
+        self.assertEqual([r['matches'] for r in results], [[d] for d in devices])
+        self.assertTrue(self.session.multicall)
+
+    def test_http_error_keeps_multicall(self):
+        self.session.login()
+        self.server.fail_next = True
+        results = self.session.call_many([
+            ('device.r_get2', ({'id': device},))
+            for device in ('d1', 'd2', 'd3')
+        ])
+
+        self.assertEqual(len(results), 3)
+        self.assertTrue(self.session.multicall)
+
+
+
+class MetadataCacheTest(unittest.TestCase):
+
+    def test_ids_match_as_numbers_and_text(self):
+        cache = MetadataCache({'device': 60})
+        cache.set('device', 1234, {'id': 1234})
+
+        self.assertEqual(cache.get('device', '1234'), (True, {'id': 1234}))
+        cache.invalidate('device', '1234')
+        self.assertEqual(cache.get('device', 1234), (False, None))
+
+    def test_invalidate_kind_and_all(self):
+        cache = MetadataCache({'device': 60, 'contact': 60})
+        cache.set('device', 1, {})
+        cache.set('contact', 1, {})
+
+        cache.invalidate('device')
+        self.assertFalse(cache.get('device', 1)[0])
+        self.assertTrue(cache.get('contact', 1)[0])
+        cache.invalidate()
+        self.assertFalse(cache.get('contact', 1)[0])
+
+    def test_kinds_without_ttl_not_cached(self):
+        cache = MetadataCache({'device': 0})
+        cache.set('device', 1, {})
+        self.assertFalse(cache.get('device', 1)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
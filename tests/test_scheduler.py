@@ -0,0 +1,136 @@
+# Tests for the priority scheduler of queued alerts.
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ecs.scheduler import AlertScheduler, parse_weights
+from ecs.workers import QueueFull, OVERFLOW_DROP_OLDEST
+
+
+def alert(organisation='o', monitor='m', device='d', status='DOWN'):
+    return {
+        'organisation': organisation,
+        'monitor': monitor,
+        'device': device,
+        'status': status
+    }
+
+
+class AlertSchedulerTest(unittest.TestCase):
+
+    def drain(self, scheduler):
+        scheduler.close()
+        items = []
+        while True:
+            item = scheduler.get()
+            if item is None:
+                return items
+            items.append(item)
+
+    def test_parse_weights(self):
+        self.assertEqual(
+            parse_weights('down:4, UP:1', upper=True),
+            {'DOWN': 4.0, 'UP': 1.0}
+        )
+        self.assertRaises(ValueError, parse_weights, 'DOWN')
+        self.assertRaises(ValueError, parse_weights, 'DOWN:0')
+
+    def test_priority_between_monitors(self):
+        scheduler = AlertScheduler(0, status_weights={'DOWN': 4, 'UP': 1})
+        scheduler.put((1, alert(monitor='m1', status='UP')))
+        scheduler.put((2, alert(monitor='m2', status='DOWN')))
+
+        self.assertEqual([i for i, a in self.drain(scheduler)], [2, 1])
+
+    def test_arrival_order_per_monitor_and_device(self):
+        scheduler = AlertScheduler(0, status_weights={'DOWN': 4, 'UP': 1})
+        for i, status in enumerate(('DOWN', 'UP', 'DOWN')):
+            scheduler.put((i, alert(monitor='m1', status=status)))
+        scheduler.put((3, alert(monitor='m2', status='DOWN')))
+
+        statuses = [
+            a['status'] for i, a in self.drain(scheduler)
+            if a['monitor'] == 'm1'
+        ]
+        self.assertEqual(statuses, ['DOWN', 'UP', 'DOWN'])
+
+    def test_organisations_served_fairly(self):
+        scheduler = AlertScheduler(0)
+        for i in range(10):
+            scheduler.put((i, alert(organisation='storm', monitor=str(i))))
+        scheduler.put((10, alert(organisation='quiet')))
+
+        served = [a['organisation'] for i, a in self.drain(scheduler)]
+        self.assertLessEqual(served.index('quiet'), 1)
+
+    def test_organisation_weights(self):
+        scheduler = AlertScheduler(0, organisation_weights={'heavy': 3})
+        for i in range(20):
+            scheduler.put((i, alert(organisation='heavy', monitor=str(i))))
+            scheduler.put((i, alert(organisation='light', monitor=str(i))))
+
+        served = [a['organisation'] for i, a in self.drain(scheduler)][:16]
+        self.assertEqual(served.count('heavy'), 12)
+
+    def test_reject_when_full(self):
+        scheduler = AlertScheduler(2)
+        scheduler.put((1, alert(monitor='1')))
+        scheduler.put((2, alert(monitor='2')))
+
+        self.assertRaises(QueueFull, scheduler.put, (3, alert(monitor='3')))
+        self.assertEqual(scheduler.rejected, 1)
+        self.assertEqual(len(scheduler), 2)
+
+    def test_organisation_max_size(self):
+        scheduler = AlertScheduler(0, organisation_max_size=1)
+        scheduler.put((1, alert(organisation='a')))
+
+        accepted, dropped = scheduler.put_many([
+            (2, alert(organisation='a')),
+            (3, alert(organisation='b'))
+        ])
+        self.assertEqual(accepted, [False, True])
+        self.assertEqual(scheduler.depths(), {'a': 1, 'b': 1})
+
+    def test_drop_oldest_from_largest_organisation(self):
+        scheduler = AlertScheduler(5, overflow=OVERFLOW_DROP_OLDEST)
+        for i in range(4):
+            scheduler.put((i, alert(organisation='big', monitor=str(i))))
+        scheduler.put((4, alert(organisation='small')))
+
+        dropped = scheduler.put((5, alert(organisation='small')))
+        self.assertEqual(dropped[0], 0)
+        self.assertEqual(scheduler.depths(), {'big': 3, 'small': 2})
+        self.assertEqual(scheduler.dropped, 1)
+        self.assertNotIn(0, [i for i, a in self.drain(scheduler)])
+
+    def test_order_kept_under_random_load(self):
+        rand = random.Random(1)
+        scheduler = AlertScheduler(
+            300,
+            overflow=OVERFLOW_DROP_OLDEST,
+            organisation_max_size=100,
+            status_weights={'DOWN': 4, 'UP': 1}
+        )
+        last = {}
+        for i in range(20000):
+            if rand.random() < 0.55 or not len(scheduler):
+                scheduler.put((i, alert(
+                    organisation=rand.choice('abc'),
+                    monitor=str(rand.randint(0, 5)),
+                    device=str(rand.randint(0, 2)),
+                    status=rand.choice(('DOWN', 'UP'))
+                )))
+            else:
+                entry_id, a = scheduler.get()
+                key = (a['organisation'], a['monitor'], a['device'])
+                self.assertGreater(entry_id, last.get(key, -1))
+                last[key] = entry_id
+            self.assertEqual(sum(scheduler.depths().values()), len(scheduler))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+# Tests for the SMTP connection pool against a local SMTP server.
+
+import os
+import sys
+import socket
+import threading
+import unittest
+try:
+    from socketserver import ThreadingTCPServer, StreamRequestHandler
+except ImportError:
+    from SocketServer import ThreadingTCPServer, StreamRequestHandler
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'tools'
+))
+from smtp_pool import SMTPPool
+
+
+# Just enough of SMTP for smtplib, every session and message is recorded
+class SMTPHandler(StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.sessions += 1
+            server.connections.append(self.connection)
+
+        self.reply('220 localhost test SMTP')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii').strip()
+            verb = command[:4].upper()
+
+            if verb in ('HELO', 'EHLO'):
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                sender, recipients = command[10:].strip('<>'), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipient = command[8:].strip('<>')
+                if recipient.startswith('refused@'):
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(recipient)
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if line in (b'.\r\n', b''):
+                        break
+                    data.append(line)
+                with server.lock:
+                    server.messages.append(
+                        (sender, recipients, b''.join(data).decode('utf-8'))
+                    )
+                self.reply('250 OK')
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Not implemented')
+
+
+class SMTPServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SMTPHandler)
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.connections = []
+        self.messages = []
+
+    # Close every open session from the server side
+    def drop_connections(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.shutdown(socket.SHUT_RDWR)
+            connection.close()
+
+
+class SMTPPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SMTPServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def pool(self, **kwargs):
+        pool = SMTPPool(
+            '127.0.0.1',
+            port=self.server.server_address[1],
+            timeout=5,
+            **kwargs
+        )
+        self.addCleanup(pool.close)
+        return pool
+
+    def message(self, subject):
+        return 'Subject: {0}\r\n\r\nAlert\r\n'.format(subject)
+
+    def test_connection_reused(self):
+        pool = self.pool()
+        for i in range(3):
+            refused = pool.send(
+                'ecs@example.com',
+                ['a@example.com', 'b@example.com'],
+                self.message(i)
+            )
+            self.assertEqual(refused, {})
+
+        self.assertEqual(self.server.sessions, 1)
+        self.assertEqual(len(self.server.messages), 3)
+        sender, recipients, data = self.server.messages[0]
+        self.assertEqual(sender, 'ecs@example.com')
+        self.assertEqual(recipients, ['a@example.com', 'b@example.com'])
+        self.assertIn('Subject: 0', data)
+
+    def test_max_messages(self):
+        pool = self.pool(max_messages=2)
+        for i in range(3):
+            pool.send('ecs@example.com', ['a@example.com'], self.message(i))
+
+        self.assertEqual(self.server.sessions, 2)
+        self.assertEqual(len(self.server.messages), 3)
+
+    def test_dropped_connection(self):
+        pool = self.pool()
+        pool.send('ecs@example.com', ['a@example.com'], self.message(1))
+        self.server.drop_connections()
+
+        pool.send('ecs@example.com', ['a@example.com'], self.message(2))
+        self.assertEqual(self.server.sessions, 2)
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_refused_recipient(self):
+        pool = self.pool()
+        refused = pool.send(
+            'ecs@example.com',
+            ['a@example.com', 'refused@example.com'],
+            self.message(1)
+        )
+
+        self.assertEqual(list(refused), ['refused@example.com'])
+        self.assertEqual(self.server.messages[0][1], ['a@example.com'])
+
+    def test_concurrent_sends(self):
+        pool = self.pool(size=2)
+        threads = [
+            threading.Thread(
+                target=pool.send,
+                args=('ecs@example.com', ['a@example.com'], self.message(i))
+            ) for i in range(10)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(self.server.messages), 10)
+        self.assertLessEqual(self.server.sessions, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
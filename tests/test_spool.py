@@ -0,0 +1,112 @@
+# Tests for the on-disk alert spool.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ecs.spool import Spool, SEGMENT_SUFFIX
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def spool(self, **kwargs):
+        spool = Spool(self.directory, **kwargs)
+        self.addCleanup(spool.close)
+        return spool
+
+    def segments(self):
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def test_pending_entries_replayed_in_order(self):
+        spool = self.spool()
+        self.assertEqual(spool.open(), [])
+        ids = spool.append_many([{'alert': str(i)} for i in range(5)])
+        spool.done(ids[1])
+        spool.done(ids[3])
+        spool.close()
+
+        replay = self.spool().open()
+        self.assertEqual(
+            replay,
+            [(ids[0], {'alert': '0'}), (ids[2], {'alert': '2'}),
+             (ids[4], {'alert': '4'})]
+        )
+
+    def test_done_entries_not_replayed_again(self):
+        spool = self.spool()
+        spool.open()
+        entry_id = spool.append({'alert': '1'})
+        spool.close()
+
+        spool = self.spool()
+        self.assertEqual(spool.open(), [(entry_id, {'alert': '1'})])
+        spool.done(entry_id)
+        spool.close()
+
+        self.assertEqual(self.spool().open(), [])
+
+    def test_new_ids_after_replay(self):
+        spool = self.spool()
+        spool.open()
+        first = spool.append({'alert': '1'})
+        spool.close()
+
+        spool = self.spool()
+        spool.open()
+        self.assertGreater(spool.append({'alert': '2'}), first)
+
+    def test_restarts_do_not_leave_segments(self):
+        for i in range(4):
+            spool = self.spool()
+            spool.open()
+            spool.done(spool.append({'alert': str(i)}))
+            spool.close()
+        self.assertEqual(self.segments(), [])
+
+        spool = self.spool()
+        spool.open()
+        spool.append({'alert': 'pending'})
+        spool.close()
+        for i in range(3):
+            spool = self.spool()
+            self.assertEqual(len(spool.open()), 1)
+            spool.close()
+        self.assertEqual(len(self.segments()), 1)
+
+    def test_rotated_segments_compacted(self):
+        spool = self.spool(segment_max_bytes=100, compact_interval=0)
+        spool.open()
+        ids = [spool.append({'alert': str(i) * 40}) for i in range(5)]
+        self.assertGreater(len(self.segments()), 2)
+
+        for entry_id in ids[:4]:
+            spool.done(entry_id)
+        spool.compact()
+        self.assertEqual(len(spool), 1)
+        self.assertLessEqual(len(self.segments()), 2)
+
+    def test_corrupt_record_skipped(self):
+        spool = self.spool()
+        spool.open()
+        entry_id = spool.append({'alert': '1'})
+        spool.close()
+
+        path = os.path.join(self.directory, self.segments()[-1])
+        with open(path, 'a') as f:
+            f.write('{"id": 9, "alert"')
+
+        self.assertEqual(self.spool().open(), [(entry_id, {'alert': '1'})])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# Tests for the child process supervisor.
+
+import os
+import sys
+import time
+import signal
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ecs.supervisor import ProcessSupervisor
+
+PYTHON = sys.executable
+
+
+class ProcessSupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = ProcessSupervisor(poll_interval=0.01, kill_grace=0.5)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def python(self, code):
+        return [PYTHON, '-c', code]
+
+    def test_exit_code_and_callback(self):
+        exited = threading.Event()
+        child = self.supervisor.spawn(
+            self.python('import sys; sys.exit(3)'),
+            callback=lambda child: exited.set()
+        )
+
+        self.assertEqual(child.wait(), 3)
+        self.assertTrue(exited.wait(5))
+        self.assertFalse(child.killed)
+        self.assertEqual(self.supervisor.running(), 0)
+
+    def test_input_written(self):
+        path = os.path.join(self.directory, 'input')
+        data = u'x' * 1000000
+        child = self.supervisor.spawn(
+            self.python(
+                'import sys; open({0!r}, "w").write(sys.stdin.read())'.format(
+                    path
+                )
+            ),
+            input_data=data,
+            timeout=30
+        )
+
+        self.assertEqual(child.wait(), 0)
+        with open(path) as f:
+            self.assertEqual(f.read(), data)
+
+    def test_spawn_does_not_wait_for_unread_input(self):
+        start = time.time()
+        child = self.supervisor.spawn(
+            self.python('import time; time.sleep(30)'),
+            input_data=u'x' * 1000000,
+            timeout=0.2
+        )
+        self.assertLess(time.time() - start, 1)
+
+        child.wait()
+        self.assertTrue(child.killed)
+
+    def test_timeout_terminates(self):
+        child = self.supervisor.spawn(
+            self.python('import time; time.sleep(30)'),
+            timeout=0.2
+        )
+
+        self.assertEqual(child.wait(), -signal.SIGTERM)
+        self.assertTrue(child.killed)
+        self.assertLess(child.duration, 5)
+        self.assertEqual(self.supervisor.stats()['terminated'], 1)
+        self.assertEqual(self.supervisor.stats()['killed'], 0)
+
+    def test_kill_after_grace(self):
+        child = self.supervisor.spawn(
+            self.python(
+                'import signal, time\n'
+                'signal.signal(signal.SIGTERM, signal.SIG_IGN)\n'
+                'time.sleep(30)'
+            ),
+            # Long enough for the child to ignore SIGTERM before it comes
+            timeout=1
+        )
+
+        self.assertEqual(child.wait(), -signal.SIGKILL)
+        self.assertEqual(self.supervisor.stats()['terminated'], 1)
+        self.assertEqual(self.supervisor.stats()['killed'], 1)
+
+    def test_many_children(self):
+        children = [
+            self.supervisor.spawn(self.python('pass'), timeout=30)
+            for i in range(10)
+        ]
+
+        self.assertEqual([child.wait() for child in children], [0] * 10)
+        self.assertEqual(self.supervisor.stats()['spawned'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,22 +2,63 @@
 # This is a dispatch command that can be used with the dispatch_plugin to send
 # alerts for monitorscout. It works with the MS API to fetch alert contacts
 # from MS and determine how to send the alert.
+#
+# Started with --daemon it runs as a long lived service on a Unix socket,
+# keeping its configuration and MS API session between alerts. When a socket
+# is configured the normal command line invocation only hands the alert to
+# the daemon, and falls back to dispatching it in process if the daemon is
+# not running.
 
 from __future__ import print_function
 
+import os
+import sys
+import json
+import socket
+import signal
+import smtplib
 import threading
-import subprocess
+from email.mime.text import MIMEText
 from pprint import pprint as pp
 from sys import exit, stderr
 from argparse import ArgumentParser, FileType
-from logging import Formatter, getLogger, DEBUG, WARN, INFO
-from logging.handlers import SysLogHandler, RotatingFileHandler
+from logging import getLogger
 try:
     from configparser import RawConfigParser
-    from xmlrpc.client import ServerProxy, Error
+    from xmlrpc.client import Error
+    from socketserver import (
+        ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+    )
 except ImportError:
     from ConfigParser import RawConfigParser
-    from xmlrpclib import ServerProxy, Error
+    from xmlrpclib import Error
+    from SocketServer import (
+        ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+    )
+
+# Make the ecs package importable when run from a source checkout
+sys.path.insert(
+    0,
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
+from ecs.supervisor import supervisor
+from ecs.workers import AlertQueue, WorkerPool, QueueFull
+from ecs.logs import setup_logging
+from ecs.alert import Alert, ALERT_PARAMS, SUMMARY_PARAMS
+from msapi import MSSession, MetadataCache, first_match
+from notify import Notifier, Notification
+from smtp_pool import SMTPPool
+
+# Alert arguments, same as the format values from dispatch_plugin
+ALERT_KEYS = ('time',) + ALERT_PARAMS + SUMMARY_PARAMS
+
+# MS API methods returning the alerts of each monitor type
+ALERT_METHODS = {
+    'monitor': 'monitor.r_get_alerts',
+    'passive_monitor': 'monitor.passive.r_get_alerts',
+    'process_monitor': 'device.process.monitor.r_get_alerts',
+    'metric_monitor': 'metric.monitor.r_get_alerts'
+}
 
 
 parser = ArgumentParser(
@@ -26,7 +67,7 @@ parser = ArgumentParser(
                  ' this script will fail.')
 )
 
-# Pretty much same arguments here as in format_data dict from the 
+# Pretty much same arguments here as in format_data dict from the
 # dispatch_plugin
 parser.add_argument(
     '--config',
@@ -34,6 +75,24 @@ parser.add_argument(
     help='Additional configuration'
 )
 
+parser.add_argument(
+    '--daemon',
+    action='store_true',
+    help='Run as a service listening on the dispatch_ms socket'
+)
+
+parser.add_argument(
+    '--socket',
+    help='Unix socket of the dispatch_ms service, overrides ms_socket'
+)
+
+parser.add_argument(
+    '--invalidate',
+    metavar='KIND[:ID]',
+    help=('Drop cached MS API records, KIND is device, monitor,'
+          ' passive_monitor, contact, user or all')
+)
+
 parser.add_argument(
     '--time'
 )
@@ -51,8 +110,7 @@ parser.add_argument(
 )
 
 parser.add_argument(
-    '--organisation',
-    required=True
+    '--organisation'
 )
 
 parser.add_argument(
@@ -60,8 +118,7 @@ parser.add_argument(
 )
 
 parser.add_argument(
-    '--device',
-    required=True
+    '--device'
 )
 
 parser.add_argument(
@@ -76,367 +133,709 @@ parser.add_argument(
     '--monitor_type'
 )
 
-args = parser.parse_args()
-
-alert_data = {
-    'time': args.time,
-    'alert': args.alert,
-    'status': args.status,
-    'monitor': args.monitor,
-    'organisation': args.organisation,
-    'alert_time_period_state': args.alert_time_period_state,
-    'device': args.device,
-    'device_hostname': args.device_hostname,
-    'monitor_name': args.monitor_name,
-    'monitor_type': args.monitor_type,
-    'error_msg': None
-}
+parser.add_argument(
+    '--suppressed',
+    help='Number of alerts suppressed by rate limits, for summaries'
+)
 
-config = RawConfigParser()
-config.read(['ecs.cfg', 'ecs_local.cfg', '/etc/ecs.cfg'])
-if args.config:
-    config.readfp(args.config)
+parser.add_argument(
+    '--summary',
+    help='Text of a suppressed alerts summary'
+)
 
-# Setup logging
-formatter = Formatter(config.get('logging', 'log_format'))
 l = getLogger('ecs')
-if config.get('logging', 'log_handler') == 'syslog':
-    syslog_address = config.get('logging', 'syslog_address')
 
-    if syslog_address.startswith('/'):
-        h = SysLogHandler(
-            address=syslog_address,
-            facility=SysLogHandler.LOG_LOCAL0
-        )
-    else:
-        h = SysLogHandler(
-            address=(
-                config.get('logging', 'syslog_address'),
-                config.get('logging', 'syslog_port')
-            ),
-            facility=SysLogHandler.LOG_LOCAL0
-        )
-else:
-    h = RotatingFileHandler(
-        config.get('logging', 'log_file'),
-        maxBytes=config.getint('logging', 'log_max_bytes'),
-        backupCount=config.getint('logging', 'log_max_copies')
-    )
-h.setFormatter(formatter)
-l.addHandler(h)
 
-if config.get('logging', 'log_debug'):
-    l.setLevel(DEBUG)
-else:
-    l.setLevel(WARN)
+def load_config(extra=None):
+    config = RawConfigParser()
+    config.read(['ecs.cfg', 'ecs_local.cfg', '/etc/ecs.cfg'])
+    if extra:
+        if hasattr(config, 'read_file'):
+            config.read_file(extra)
+        else:
+            config.readfp(extra)
+    return config
+
+
+class MSDispatcher(object):
+    """Dispatches alerts to the contacts configured in the MS API. One
+    instance holds the configuration and session for any number of alerts.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.session = MSSession(config)
+
+        def option(name, default):
+            if config.has_option('DispatchPlugin', name):
+                return config.getint('DispatchPlugin', name)
+            return default
+
+        monitor_ttl = option('ms_cache_ttl_monitor', 300)
+        self.cache = MetadataCache({
+            'device': option('ms_cache_ttl_device', 300),
+            'monitor': monitor_ttl,
+            'passive_monitor': monitor_ttl,
+            'contact': option('ms_cache_ttl_contact', 600),
+            'user': option('ms_cache_ttl_user', 600)
+        }, max_entries=option('ms_cache_max_entries', 10000))
+
+        self.cache_snapshot = None
+        if config.has_option('DispatchPlugin', 'ms_cache_snapshot'):
+            self.cache_snapshot = config.get('DispatchPlugin', 'ms_cache_snapshot')
+        if self.cache_snapshot:
+            self.cache.load(self.cache_snapshot)
+
+        # Native SMTP delivery, email_cmd is used without it
+        self.smtp = None
+        self.smtp_merge = False
+        if (config.has_option('DispatchPlugin', 'email_backend') and
+                config.get('DispatchPlugin', 'email_backend') == 'smtp'):
+            def get(name, default=None):
+                if config.has_option('DispatchPlugin', name):
+                    return config.get('DispatchPlugin', name)
+                return default
+
+            self.smtp = SMTPPool(
+                config.get('DispatchPlugin', 'smtp_host'),
+                port=option('smtp_port', 25),
+                size=option('smtp_pool_size', 2),
+                max_messages=option('smtp_max_messages', 100),
+                timeout=option('smtp_timeout', 30),
+                starttls=get('smtp_starttls', 'False') == 'True',
+                username=get('smtp_username'),
+                password=get('smtp_password')
+            )
+            self.smtp_merge = get('smtp_merge_recipients', 'False') == 'True'
+
+        # Each channel gets its own sender threads and rate limit
+        self.notifier = Notifier()
+        for channel, concurrency in (('email', 4), ('pager', 2)):
+            self.notifier.add_channel(
+                channel,
+                concurrency=option(
+                    'notify_{0}_concurrency'.format(channel),
+                    concurrency
+                ),
+                rate=option('notify_{0}_rate'.format(channel), 0),
+                burst=option('notify_{0}_burst'.format(channel), 0)
+            )
+
+    def save_cache(self):
+        if self.cache_snapshot:
+            try:
+                self.cache.save(self.cache_snapshot)
+            except (IOError, OSError) as e:
+                l.exception('Saving cache snapshot failed')
+
+    # Connect to MS API and get a session ID
+    def login(self):
+        return self.session.get_sid()
+
+    # Fetch records from the cache or the MS API. Lookups are given as
+    # (kind, r_get2 method, ID) and any uncached records are fetched in one
+    # batch together with the extra (method, args) calls. Returns the records,
+    # None where nothing was found, and the results of the extra calls.
+    def lookup_many(self, lookups, extra_calls=()):
+        records = []
+        missing = []
+        for kind, method, entity_id in lookups:
+            found, record = self.cache.get(kind, entity_id)
+            records.append(record)
+            if not found:
+                missing.append(len(records) - 1)
+
+        calls = [
+            (lookups[i][1], ({'id': lookups[i][2]},)) for i in missing
+        ] + list(extra_calls)
+        results = self.session.call_many(calls) if calls else []
+
+        for i, result in zip(missing, results):
+            kind, method, entity_id = lookups[i]
+            records[i] = first_match(result)
+            self.cache.set(kind, entity_id, records[i])
+
+        return records, results[len(missing):]
+
+    # Execute alert command under the shared process supervisor
+    def alert_command(self, command, input_data):
+        if self.config.has_option('DispatchPlugin', 'timeout'):
+            timeout = self.config.getint('DispatchPlugin', 'timeout')
+        else:
+            timeout = None
 
+        child = supervisor.spawn(
+            command,
+            input_data=input_data,
+            timeout=timeout
+        )
+        returncode = child.wait()
 
-# Timeout callback helper function
-def timeout_callback(self, p):
-    if p.poll() is None:
-        try:
-            p.kill()
-            l.error('Process {pid} taking too long, killed'.format(
-                pid=p.pid
+        if returncode:
+            l.error('Alert command exited with {code}'.format(
+                code=returncode
             ))
-        except OSError as e:
-            if e.errno != errno.ESRCH:
-                raise
 
+        return returncode
+
+    # Send an E-mail alert
+    def email_alert(self, recipient, alert={}):
+        alert = dict(alert)
+        email_message = (
+            'Alert from www.monitorscout.com\n'
+            '\n'
+            'Delivered from www.monitorscout.com via Cygatehosting ECS API\n'
+            '\n'
+            'Device: https://monitorscout.com/device/{device}\n'
+            'Monitor: https://monitorscout.com/monitor/{device}/{monitor_type}/{monitor}\n'
+            'Acknowledge alert: https://monitorscout.com/alert/unhandled/{monitor_type}_alert/{monitor}/\n'
+            '\n'
+            'Alert Time Period State: {alert_time_period_state}\n'
+            '\n'
+            'Device name: {device_hostname}\n'
+            'Monitor name: {monitor_name}\n'
+            'State: {status}\n'
+            'Time: {time}\n'
+        ).format(**alert)
 
-# Execute alert command
-def alert_command(command, input_data):
-    proc_stdin = subprocess.PIPE
+        if alert.get('error_msg', None):
+            email_message += (
+                'Error: {error_msg}\n'
+            ).format(**alert)
 
-    proc = subprocess.Popen(
-        command,
-        stdin=proc_stdin
-    )
+        if alert.get('summary', None):
+            email_message += (
+                '\n'
+                'Rate limited: {summary}\n'
+            ).format(**alert)
 
-    timer = threading.Timer(
-        config.getint('DispatchPlugin', 'timeout'),
-        timeout_callback,
-        [proc]
-    )
-    timer.start()
+        alert['subject'] = self.config.get(
+            'DispatchPlugin',
+            'email_subject'
+        ).format(**alert)
 
-    (stdout, stderr) = proc.communicate(input_data)
+        alert['from'] = self.config.get('DispatchPlugin', 'email_from')
+        alert['return_path'] = self.config.get(
+            'DispatchPlugin',
+            'email_return_path'
+        )
+        alert['reply_to'] = self.config.get('DispatchPlugin', 'email_reply_to')
 
-    if stderr:
-        l.error('Alert command error: {error}'.format(
-            error=stderr
-        ))
+        # Merged notifications have a list of recipients
+        if isinstance(recipient, list):
+            recipients = recipient
+        else:
+            recipients = [recipient]
+
+        if self.smtp is not None:
+            try:
+                return self.smtp_alert(recipients, alert, email_message)
+            except (smtplib.SMTPException, socket.error) as e:
+                if not self.config.has_option('DispatchPlugin', 'email_cmd'):
+                    raise
+                l.warning('SMTP delivery failed, using email_cmd: {error}'.format(
+                    error=e
+                ))
+
+        returncode = 0
+        for recipient in recipients:
+            l.debug('Sending e-mail message to %s', recipient)
+            alert['email'] = recipient
+
+            command = self.config.get('DispatchPlugin', 'email_cmd')
+            cmd_args = []
+            for _cmd in command.split(' '):
+                cmd_args.append(_cmd.format(**alert))
+
+            l.debug('Executing email command: %s', cmd_args)
+            returncode = self.alert_command(cmd_args, email_message) or returncode
+            l.debug('Command finished: %s', returncode)
+        return returncode
+
+    # Deliver an e-mail alert through the SMTP connection pool
+    def smtp_alert(self, recipients, alert, email_message):
+        message = MIMEText(email_message, 'plain', 'utf-8')
+        message['Subject'] = alert['subject']
+        message['From'] = alert['from']
+        message['Reply-To'] = alert['reply_to']
+        if len(recipients) == 1:
+            message['To'] = recipients[0]
+        else:
+            message['To'] = 'undisclosed-recipients:;'
 
-    timer.cancel()
-    timer.join()
-
-    return stdout
-
-
-# Send an E-mail alert
-def email_alert(recipient, alert={}):
-    email_message = (
-        'Alert from www.monitorscout.com\n'
-        '\n'
-        'Delivered from www.monitorscout.com via Cygatehosting ECS API\n'
-        '\n'
-        'Device: https://monitorscout.com/device/{device}\n'
-        'Monitor: https://monitorscout.com/monitor/{device}/{monitor_type}/{monitor}\n'
-        'Acknowledge alert: https://monitorscout.com/alert/unhandled/{monitor_type}_alert/{monitor}/\n'
-        '\n'
-        'Alert Time Period State: {alert_time_period_state}\n'
-        '\n'
-        'Device name: {device_hostname}\n'
-        'Monitor name: {monitor_name}\n'
-        'State: {status}\n'
-        'Time: {time}\n'
-    ).format(**alert)
-
-    if alert.get('error_msg', None):
-        email_message += (
-            'Error: {error_msg}\n'
+        l.debug(
+            'Sending e-mail message over SMTP to %s',
+            ', '.join(recipients)
+        )
+        refused = self.smtp.send(
+            alert['return_path'] or alert['from'],
+            recipients,
+            message.as_string()
+        )
+
+        if refused:
+            l.error('SMTP server refused {recipients}'.format(
+                recipients=', '.join(refused)
+            ))
+            return 1
+        return 0
+
+    # Send pager alert
+    def pager_alert(self, recipient, alert={}):
+        alert = dict(alert)
+        pager_message = (
+            'Alert from www.monitorscout.com\n'
+            '\n'
+            'Device name: {device_hostname}\n'
+            'Monitor name: {monitor_name}\n'
+            'State: {status}\n'
+            'Time: {time}\n'
         ).format(**alert)
 
-    l.debug('Sending e-mail message to {rcpt}'.format(
-        rcpt=recipient
-    ))
+        if alert.get('error_msg', None):
+            pager_message += (
+                'Error: {error_msg}\n'
+            ).format(**alert)
+
+        if alert.get('summary', None):
+            pager_message += (
+                'Rate limited: {summary}\n'
+            ).format(**alert)
+
+        l.debug('Sending pager message')
+
+        alert['pager'] = recipient
+
+        command = self.config.get('DispatchPlugin', 'pager_cmd')
+        cmd_args = []
+        for _cmd in command.split(' '):
+            cmd_args.append(_cmd.format(**alert))
+
+        l.debug('Executing pager command: %s', cmd_args)
+        returncode = self.alert_command(cmd_args, pager_message)
+        l.debug('Command finished: %s', returncode)
+        return returncode
+
+    # Fetch contacts for one Alert from the MS API and notify them, returns
+    # the notifications that failed
+    def dispatch(self, alert):
+        alert_data = dict(alert.context())
+        alert_data['error_msg'] = None
+
+        # Device, monitor and alert data are fetched in one batch
+        device_id = alert_data.get('device')
+        monitor_id = alert_data.get('monitor')
+        monitor_type = alert_data.get('monitor_type')
+
+        if monitor_type == 'passive_monitor':
+            monitor_lookup = (
+                'passive_monitor',
+                'monitor.passive.r_get2',
+                monitor_id
+            )
+        else:
+            monitor_lookup = ('monitor', 'monitor.r_get2', monitor_id)
+
+        alert_calls = []
+        if alert_data.get('alert'):
+            method = ALERT_METHODS.get(monitor_type)
+            if method:
+                alert_calls.append((method, (monitor_id, '')))
+
+        (device, monitor), alert_results = self.lookup_many([
+            ('device', 'device.r_get2', device_id),
+            monitor_lookup
+        ], alert_calls)
+
+        # Add the error_msg to our own dict of alert_data
+        if alert_results and alert_results[0]:
+            _alert_data = alert_results[0]['entity_data'].get(
+                alert_data['alert']
+            )
+            if _alert_data:
+                alert_data['error_msg'] = _alert_data['error_msg']
+
+        # Contact handling code, handles stuff like if contacts should receive
+        # alerts and what type of alerts they should receive.
+        contacts = []
+
+        # Get the device contacts
+        if device is None:
+            l.debug('No such device found')
+        else:
+            device_alerts_enabled = device.get('alerts_enabled')
 
-    alert['subject'] = config.get('DispatchPlugin', 'email_subject').format(
-        **alert
-    )
+            if device_alerts_enabled:
+                # Get the contacts of the first device in the search results
+                dev_contacts = device.get('alert_user_contacts')
 
-    alert['email'] = recipient
-    alert['from'] = config.get('DispatchPlugin', 'email_from')
-    alert['return_path'] = config.get('DispatchPlugin', 'email_return_path')
-    alert['reply_to'] = config.get('DispatchPlugin', 'email_reply_to')
+                if not len(dev_contacts):
+                    l.debug('%s: No contacts found for device', device_id)
+                else:
+                    contacts.extend(dev_contacts)
 
-    command = config.get('DispatchPlugin', 'email_cmd')
-    cmd_args = []
-    for _cmd in command.split(' '):
-        cmd_args.append(_cmd.format(**alert))
+                dev_users = device.get('alert_users')
 
-    l.debug('Executing email command: {cmd}'.format(
-        cmd=cmd_args
-    ))
-    stdout = alert_command(cmd_args, email_message)
-    l.debug('Command finished: {stdout}'.format(
-        stdout=stdout
-    ))
+                if not len(dev_users):
+                    l.debug('%s: No users found for device', device_id)
+                else:
+                    contacts.extend(dev_users)
+            else:
+                l.debug('%s: Alerts disabled for device, skipping', device_id)
 
+        # Get monitor contacts
+        if monitor is None:
+            l.debug('No such monitor found')
+        else:
+            monitor_alerts_enabled = monitor.get('alerts_enabled')
+
+            if monitor_alerts_enabled:
+                mon_contacts = monitor.get('alert_user_contacts')
+
+                if not len(mon_contacts):
+                    l.debug('No contacts found on monitor')
+                else:
+                    contacts.extend(mon_contacts)
+
+                mon_users = monitor.get('alert_users')
+
+                if not len(mon_users):
+                    l.debug('%s: No users found on monitor', monitor_id)
+                else:
+                    contacts.extend(mon_users)
+            else:
+                l.debug(
+                    '%s: Alerts disabled for monitor, skipping',
+                    monitor_id
+                )
 
-# Send pager alert
-def pager_alert(recipient, alert={}):
-    pager_message = (
-        'Alert from www.monitorscout.com\n'
-        '\n'
-        'Device name: {device_hostname}\n'
-        'Monitor name: {monitor_name}\n'
-        'State: {status}\n'
-        'Time: {time}\n'
-    ).format(**alert)
-
-    if alert.get('error_msg', None):
-        pager_message += (
-            'Error: {error_msg}\n'
-        ).format(**alert)
+        # Sort the found contacts so we have unique ID values.
+        sorted_contacts = sorted(set(contacts))
+        l.debug('Processing contacts: %s', sorted_contacts)
+
+        # Fetch contact JSON data from MS API in batches, IDs that are not
+        # contacts are looked up as users.
+        found, _ = self.lookup_many([
+            ('contact', 'user.contact.r_get2', contact)
+            for contact in sorted_contacts
+        ])
+
+        users = [
+            contact for contact, c in zip(sorted_contacts, found) if c is None
+        ]
+        for contact in users:
+            l.debug('%s: No such contact found', contact)
+
+        found_users, _ = self.lookup_many([
+            ('user', 'user.r_get2', contact) for contact in users
+        ])
+        found_users = dict(zip(users, found_users))
+
+        # For all contacts found we attempt to send e-mail and pager messages
+        # depending on their settings.
+        notifications = []
+        for contact, c in zip(sorted_contacts, found):
+            if c is None:
+                c = found_users[contact]
+
+            if c is None:
+                l.debug('%s: No such user found', contact)
+                continue
+
+            if c.get('notify_by_email', False):
+                if not c.get('email_verified', False):
+                    l.debug(
+                        '%s: Email not verified',
+                        c.get('email', c.get('id'))
+                    )
+
+                if not c.get('email', False):
+                    l.debug('%s: Email not present', c.get('id'))
+
+                if c.get('email_verified') and c.get('email'):
+                    notifications.append(Notification(
+                        'email',
+                        c.get('email'),
+                        self.email_alert,
+                        (alert_data,)
+                    ))
+
+            if c.get('notify_by_pager', False):
+                if not c.get('pager_verified', False):
+                    l.debug(
+                        '%s: Pager not verified',
+                        c.get('pager_number', c.get('id'))
+                    )
+
+                if not c.get('pager_number', False):
+                    l.debug('%s: Pager not present', c.get('id'))
+
+                if c.get('pager_verified') and c.get('pager_number'):
+                    notifications.append(Notification(
+                        'pager',
+                        c.get('pager_number'),
+                        self.pager_alert,
+                        (alert_data,)
+                    ))
+
+        # One e-mail with all recipients in the envelope
+        if self.smtp_merge:
+            emails = [n for n in notifications if n.channel == 'email']
+            if len(emails) > 1:
+                notifications = [
+                    n for n in notifications if n.channel != 'email'
+                ]
+                notifications.append(Notification(
+                    'email',
+                    [n.recipient for n in emails],
+                    self.email_alert,
+                    (alert_data,)
+                ))
+
+        if not notifications:
+            return []
+
+        self.notifier.send(notifications)
+
+        failed = [n for n in notifications if not n.ok]
+        l.info('Alert {alert}: {sent} of {total} notifications sent{failed}'.format(
+            alert=alert_data.get('alert'),
+            sent=len(notifications) - len(failed),
+            total=len(notifications),
+            failed=''.join(
+                ', {channel} to {recipient} failed: {error}'.format(
+                    channel=n.channel,
+                    recipient=n.recipient,
+                    error=n.error
+                ) for n in failed
+            )
+        ))
+        return failed
 
-    l.debug('Sending pager message')
 
-    alert['pager'] = recipient
+class DeliveryFailed(Exception):
+    pass
 
-    command = config.get('DispatchPlugin', 'pager_cmd')
-    cmd_args = []
-    for _cmd in command.split(' '):
-        cmd_args.append(_cmd.format(**alert))
 
-    l.debug('Executing pager command: {cmd}'.format(
-        cmd=cmd_args
-    ))
-    stdout = alert_command(cmd_args, pager_message)
-    l.debug('Command finished: {stdout}'.format(
-        stdout=stdout
-    ))
+# An alert queued in the daemon, the connection that sent it waits for done
+class Delivery(object):
 
+    def __init__(self, alert):
+        self.alert = alert
+        self.done = threading.Event()
+        self.error = None
 
-if not config.get('DispatchPlugin', 'ms_api_host'):
-    parser.print_help()
-    exit(1)
 
-try:
-    # Connect to MS API
-    server = ServerProxy('http://{ms_api_host}:{ms_api_port}/'.format(
-        ms_api_host=config.get('DispatchPlugin', 'ms_api_host'),
-        ms_api_port=config.getint('DispatchPlugin', 'ms_api_port')
-    ))
+# Daemon worker, dispatches one queued alert and records the outcome
+def deliver(dispatcher, delivery):
+    try:
+        failed = dispatcher.dispatch(delivery.alert)
+        if failed:
+            delivery.error = '{count} notifications failed'.format(
+                count=len(failed)
+            )
+    except Exception as e:
+        delivery.error = str(e) or type(e).__name__
+        raise
+    finally:
+        delivery.done.set()
 
-    # Get a session ID
-    sid = server.login(
-        config.get('DispatchPlugin', 'ms_api_username'),
-        config.get('DispatchPlugin', 'ms_api_password'),
-        config.get('DispatchPlugin', 'ms_api_account')
-    )
-except Error as e:
-    print('Connection to MS API failed: {error}'.format(
-        error=str(e)
-    ), file=stderr)
-    exit(1)
-
-# Get the alert data
-if len(args.alert):
-    _alert = None
-    if args.monitor_type == 'monitor':
-        _alert = server.monitor.r_get_alerts(sid, args.monitor, '')
-    elif args.monitor_type == 'passive_monitor':
-        _alert = server.monitor.passive.r_get_alerts(sid, args.monitor, '')
-    elif args.monitor_type == 'process_monitor':
-        _alert = server.device.process.monitor.r_get_alerts(sid, args.monitor, '')
-    elif args.monitor_type == 'metric_monitor':
-        _alert = server.metric.monitor.r_get_alerts(sid, args.monitor, '')
-
-    # Add the error_msg to our own dict of alert_data
-    if _alert:
-        _alert_data = _alert['entity_data'].get(args.alert)
-        alert_data['error_msg'] = _alert_data['error_msg']
-
-
-# Contact handling code, handles stuff like if contacts should receive alerts
-# and what type of alerts they should receive.
-contacts = []
-
-# Get the device contacts
-device_id = args.device
-device_data = server.device.r_get2(sid, {'id': device_id})
-
-if not len(device_data['matches']):
-    l.debug('No such device found')
-else:
-    device = device_data['entity_data'][device_data['matches'][0]]
-    device_alerts_enabled = device.get('alerts_enabled')
-
-    if device_alerts_enabled:
-        # Get the contacts of the first device in the search results
-        dev_contacts = device.get('alert_user_contacts')
-
-        if not len(dev_contacts):
-            l.debug('{device}: No contacts found for device'.format(
-                device=device_id
-            ))
-        else:
-            contacts.extend(dev_contacts)
 
-        dev_users = device.get('alert_users')
+# Reads one JSON alert record per line and queues it for the dispatcher
+# workers. Each line is answered once the alert has been dispatched, with ok,
+# or with failed if it could not be delivered, so the sender can retry it.
+# Records that are not queued are answered with an error right away. A
+# record with an invalidate key drops cached MS API records instead.
+class AlertRequestHandler(StreamRequestHandler):
 
-        if not len(dev_users):
-            l.debug('{device}: No users found for device'.format(
-                device=device_id
-            ))
-        else:
-            contacts.extend(dev_users)
-    else:
-        l.debug('{device}: Alerts disabled for device, skipping'.format(
-            device=device_id
-        ))
+    def handle(self):
+        for line in self.rfile:
+            try:
+                record = json.loads(line.decode('utf-8'))
+                if 'invalidate' in record:
+                    self.server.dispatcher.cache.invalidate(
+                        record['invalidate'],
+                        record.get('id')
+                    )
+                    self.wfile.write(b'ok\n')
+                    continue
+
+                delivery = Delivery(Alert.loads(record))
+                self.server.alert_queue.put(delivery)
+            except QueueFull:
+                self.wfile.write(b'error queue full\n')
+                continue
+            except Exception as e:
+                l.exception('Invalid alert record')
+                self.wfile.write(b'error invalid record\n')
+                continue
 
+            delivery.done.wait()
+            if delivery.error is None:
+                self.wfile.write(b'ok\n')
+            else:
+                self.wfile.write('failed {error}\n'.format(
+                    error=delivery.error.replace('\n', ' ')
+                ).encode('utf-8'))
 
-# Get monitor contacts
-monitor_id = args.monitor
-if args.monitor_type == 'passive_monitor':
-    monitor_data = server.monitor.passive.r_get2(sid, {'id': monitor_id})
-else:
-    monitor_data = server.monitor.r_get2(sid, {'id': monitor_id})
 
-if not len(monitor_data['matches']):
-    l.debug('No such monitor found')
-else:
-    monitor = monitor_data['entity_data'][monitor_data['matches'][0]]
-    monitor_alerts_enabled = monitor.get('alerts_enabled')
+class AlertServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
 
-    if monitor_alerts_enabled:
-        mon_contacts = monitor.get('alert_user_contacts')
 
-        if not len(mon_contacts):
-            l.debug('No contacts found on monitor')
-        else:
-            contacts.extend(mon_contacts)
+def serve(config, socket_path):
+    dispatcher = MSDispatcher(config)
+    dispatcher.login()
 
-        mon_users = monitor.get('alert_users')
+    alert_queue = AlertQueue(
+        config.getint('DispatchPlugin', 'ms_daemon_queue_size')
+        if config.has_option('DispatchPlugin', 'ms_daemon_queue_size')
+        else 1000
+    )
 
-        if not len(mon_users):
-            l.debug('{monitor}: No users found on monitor'.format(
-                monitor=monitor_id
+    workers = WorkerPool(
+        alert_queue,
+        lambda delivery: deliver(dispatcher, delivery),
+        config.getint('DispatchPlugin', 'ms_daemon_workers')
+        if config.has_option('DispatchPlugin', 'ms_daemon_workers')
+        else 4
+    )
+    workers.start()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = AlertServer(socket_path, AlertRequestHandler)
+    server.alert_queue = alert_queue
+    server.dispatcher = dispatcher
+
+    def shutdown(signum, frame):
+        raise SystemExit
+
+    signal.signal(signal.SIGTERM, shutdown)
+    l.info('dispatch_ms listening on {path}'.format(path=socket_path))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        workers.stop()
+        dispatcher.save_cache()
+
+
+# Hand a record to the daemon and wait until it has been dispatched. Raises
+# socket.error if the daemon is not running and RuntimeError if it refused
+# the record, in both cases nothing was sent. Raises DeliveryFailed if the
+# daemon took the record but did not deliver it within timeout seconds.
+def send_to_daemon(socket_path, record, timeout=60):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(5)
+        s.connect(socket_path)
+        s.sendall(json.dumps(record).encode('utf-8') + b'\n')
+        s.shutdown(socket.SHUT_WR)
+        s.settimeout(timeout)
+        try:
+            reply = s.makefile('rb').readline().decode('utf-8').strip()
+        except socket.timeout:
+            raise DeliveryFailed('no reply within {timeout}s'.format(
+                timeout=timeout
             ))
-        else:
-            contacts.extend(mon_users)
-    else:
-        l.debug('{monitor}: Alerts disabled for monitor, skipping'.format(
-            monitor=monitor_id
-        ))
+    finally:
+        s.close()
 
-# Sort the found contacts so we have unique ID values.
-sorted_contacts = sorted(set(contacts))
-l.debug('Processing contacts: {contacts}'.format(
-    contacts=sorted_contacts
-))
-
-# For all contacts found we attempt to send e-mail and pager messages
-# depending on their settings.
-for contact in sorted_contacts:
-    # Fetch contact JSON data from MS API
-    contact_data = server.user.contact.r_get2(sid, {'id': contact})
-
-    if not len(contact_data['matches']):
-        l.debug('{contact}: No such contact found'.format(
-            contact=contact
-        ))
+    if reply.startswith('failed'):
+        raise DeliveryFailed(reply[len('failed'):].strip())
+    if reply != 'ok':
+        raise RuntimeError(reply or 'no reply')
 
-        contact_data = server.user.r_get2(sid, {'id': contact})
 
-    if not len(contact_data['matches']):
-        l.debug('{contact}: No such user found'.format(
-            contact=contact
-        ))
-        continue
+def main():
+    args = parser.parse_args()
+    config = load_config(args.config)
+    setup_logging(config)
 
-    c = contact_data['entity_data'][contact_data['matches'][0]]
+    if not config.get('DispatchPlugin', 'ms_api_host'):
+        parser.print_help()
+        exit(1)
 
-    if c.get('notify_by_email', False):
-        if not c.get('email_verified', False):
-            l.debug('{contact}: Email not verified'.format(
-                contact=c.get('email', c.get('id'))
-            ))
+    socket_path = args.socket
+    if not socket_path and config.has_option('DispatchPlugin', 'ms_socket'):
+        socket_path = config.get('DispatchPlugin', 'ms_socket')
 
-        if not c.get('email', False):
-            l.debug('{contact}: Email not present'.format(
-                contact=c.get('id')
-            ))
+    if args.daemon:
+        if not socket_path:
+            parser.error('--daemon requires --socket or ms_socket')
+        serve(config, socket_path)
+        return
+
+    if args.invalidate:
+        kind, _, entity_id = args.invalidate.partition(':')
+        if kind == 'all':
+            kind = None
+        record = {'invalidate': kind, 'id': entity_id or None}
 
-        if c.get('email_verified') and c.get('email'):
+        if socket_path:
             try:
-                email_alert(
-                    c.get('email'),
-                    alert_data
-                )
-            except Exception as e:
-                l.exception('Email alert failed with exception')
-                pass
+                send_to_daemon(socket_path, record)
+                return
+            except (socket.error, RuntimeError) as e:
+                l.warning('dispatch_ms daemon unavailable, editing cache snapshot: {error}'.format(
+                    error=str(e)
+                ))
+
+        dispatcher = MSDispatcher(config)
+        dispatcher.cache.invalidate(record['invalidate'], record['id'])
+        dispatcher.save_cache()
+        return
+
+    if not args.organisation or not args.device:
+        parser.error('--organisation and --device are required')
+
+    alert = Alert.from_params(dict(
+        (k, getattr(args, k)) for k in ALERT_KEYS
+        if getattr(args, k) is not None
+    ))
 
-    if c.get('notify_by_pager', False):
-        if not c.get('pager_verified', False):
-            l.debug('{contact}: Pager not verified'.format(
-                contact=c.get('pager_number', c.get('id'))
+    if socket_path:
+        timeout = 60
+        if config.has_option('DispatchPlugin', 'ms_daemon_timeout'):
+            timeout = config.getfloat('DispatchPlugin', 'ms_daemon_timeout')
+        try:
+            send_to_daemon(socket_path, alert.record(), timeout)
+            return
+        except DeliveryFailed as e:
+            l.error('Alert {alert} not delivered by dispatch_ms daemon: {error}'.format(
+                alert=alert.get('alert'),
+                error=str(e)
             ))
-
-        if not c.get('pager_number', False):
-            l.debug('{contact}: Pager not present'.format(
-                contact=c.get('id')
+            exit(1)
+        except (socket.error, RuntimeError) as e:
+            l.warning('dispatch_ms daemon unavailable, dispatching in process: {error}'.format(
+                error=str(e)
             ))
 
-        if c.get('pager_verified') and c.get('pager_number'):
-            try:
-                pager_alert(
-                    c.get('pager_number'),
-                    alert_data
-                )
-            except Exception as e:
-                l.exception('Pager alert failed with exception')
-                pass
+    dispatcher = MSDispatcher(config)
+    if dispatcher.notifier.rate_limited():
+        l.warning('Notification rate limits only apply to this alert, run the dispatch_ms service to limit the rate across alerts')
+    try:
+        dispatcher.login()
+    except Error as e:
+        print('Connection to MS API failed: {error}'.format(
+            error=str(e)
+        ), file=stderr)
+        exit(1)
+
+    try:
+        failed = dispatcher.dispatch(alert)
+    finally:
+        dispatcher.save_cache()
+
+    # A non-zero exit makes DispatchPlugin retry the alert
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
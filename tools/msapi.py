@@ -0,0 +1,381 @@
+# MS API client used by dispatch_ms.
+#
+# MSSession caches the session ID and logs in again only when the MS API
+# rejects it or it has been used longer than the configured TTL. Calls go
+# through PooledTransport which keeps persistent HTTP/1.1 connections in a
+# small pool with connect and read timeouts. MetadataCache keeps device,
+# monitor, contact and user records between alerts.
+
+import os
+import json
+import time
+import errno
+import socket
+import threading
+try:
+    from xmlrpc.client import (
+        ServerProxy, Transport, MultiCall, Fault, ProtocolError
+    )
+    from http.client import HTTPConnection, BadStatusLine
+except ImportError:
+    from xmlrpclib import (
+        ServerProxy, Transport, MultiCall, Fault, ProtocolError
+    )
+    from httplib import HTTPConnection, BadStatusLine
+from logging import getLogger
+
+l = getLogger('ecs')
+
+# Words in a fault from the MS API that mean the session is not valid
+SESSION_FAULT_WORDS = ('session', 'login', 'auth', 'sid')
+
+
+# True if a request failed because the server closed an idle pooled
+# connection. A timeout means the server is slow, sending the request again
+# would only wait again.
+def stale_connection(error):
+    if isinstance(error, BadStatusLine):
+        return True
+    if isinstance(error, socket.timeout):
+        return False
+    return getattr(error, 'errno', None) in (
+        errno.ECONNRESET,
+        errno.ECONNABORTED,
+        errno.EPIPE
+    )
+
+
+class PooledTransport(Transport):
+
+    def __init__(self, pool_size=4, connect_timeout=5, read_timeout=30,
+                 use_datetime=False):
+        Transport.__init__(self, use_datetime=use_datetime)
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool = []
+        self.pool_lock = threading.Lock()
+        self.connections = 0
+
+    # Returns (connection, reused)
+    def _acquire(self, host):
+        with self.pool_lock:
+            if self.pool:
+                return self.pool.pop(), True
+
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        conn = HTTPConnection(chost, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        self.connections += 1
+        return conn, False
+
+    def _release(self, conn):
+        with self.pool_lock:
+            if len(self.pool) < self.pool_size:
+                self.pool.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.pool_lock:
+            pool, self.pool = self.pool, []
+        for conn in pool:
+            conn.close()
+
+    def request(self, host, handler, request_body, verbose=False):
+        self.verbose = verbose
+        while True:
+            conn, reused = self._acquire(host)
+            try:
+                conn.putrequest('POST', handler)
+                self.send_headers(conn, [
+                    ('Content-Type', 'text/xml'),
+                    ('User-Agent', self.user_agent)
+                ] + list(self._extra_headers or []))
+                self.send_content(conn, request_body)
+                resp = conn.getresponse()
+            except (BadStatusLine, socket.error) as e:
+                conn.close()
+                # The server closed an idle connection, try another one
+                if reused and stale_connection(e):
+                    continue
+                raise
+            except Exception as e:
+                conn.close()
+                raise
+            break
+
+        if resp.status != 200:
+            resp.read()
+            conn.close()
+            raise ProtocolError(
+                host + handler,
+                resp.status,
+                resp.reason,
+                dict(resp.getheaders())
+            )
+
+        try:
+            result = self.parse_response(resp)
+        except Exception as e:
+            conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return result
+
+
+class MSSession(object):
+
+    def __init__(self, config, section='DispatchPlugin'):
+        self.config = config
+        self.section = section
+
+        def option(name, default, get=config.getint):
+            if config.has_option(section, name):
+                return get(section, name)
+            return default
+
+        self.transport = PooledTransport(
+            pool_size=option('ms_api_pool_size', 4),
+            connect_timeout=option('ms_api_connect_timeout', 5, config.getfloat),
+            read_timeout=option('ms_api_read_timeout', 30, config.getfloat)
+        )
+        self.server = ServerProxy(
+            'http://{ms_api_host}:{ms_api_port}/'.format(
+                ms_api_host=config.get(section, 'ms_api_host'),
+                ms_api_port=config.getint(section, 'ms_api_port')
+            ),
+            transport=self.transport,
+            allow_none=True
+        )
+        self.session_ttl = option('ms_session_ttl', 0)
+
+        # Calls made together are sent in system.multicall batches of this
+        # size, until the MS API turns out not to support multicall.
+        self.batch_size = option('ms_api_batch_size', 20)
+        self.multicall = option('ms_api_multicall', True, config.getboolean)
+
+        # Fault codes that mean the session is not valid, on top of faults
+        # with SESSION_FAULT_WORDS in their message
+        self.session_fault_codes = set()
+        if config.has_option(section, 'ms_session_fault_codes'):
+            self.session_fault_codes = set(
+                int(code) for code in
+                config.get(section, 'ms_session_fault_codes').split(',')
+                if code.strip()
+            )
+
+        self.lock = threading.Lock()
+        self.sid = None
+        self.login_time = 0
+        self.logins = 0
+
+    def login(self):
+        sid = self.server.login(
+            self.config.get(self.section, 'ms_api_username'),
+            self.config.get(self.section, 'ms_api_password'),
+            self.config.get(self.section, 'ms_api_account')
+        )
+        self.sid = sid
+        self.login_time = time.time()
+        self.logins += 1
+        return sid
+
+    # Return a valid session ID, logging in if there is none or the one we
+    # have is older than the session TTL.
+    def get_sid(self):
+        with self.lock:
+            expired = (
+                self.session_ttl and
+                time.time() - self.login_time > self.session_ttl
+            )
+            if self.sid is None or expired:
+                self.login()
+            return self.sid
+
+    # Drop the session unless another thread already replaced it
+    def invalidate(self, sid):
+        with self.lock:
+            if self.sid == sid:
+                self.sid = None
+
+    def session_fault(self, fault):
+        if fault.faultCode in self.session_fault_codes:
+            return True
+        message = str(fault.faultString).lower()
+        return any(word in message for word in SESSION_FAULT_WORDS)
+
+    def method(self, name, target=None):
+        method = target or self.server
+        for part in name.split('.'):
+            method = getattr(method, part)
+        return method
+
+    # Call an MS API method with the session ID as first argument, logging
+    # in again once if the MS API rejects the session. Other faults are
+    # raised as they are.
+    def call(self, name, *args):
+        sid = self.get_sid()
+        try:
+            return self.method(name)(sid, *args)
+        except Fault as e:
+            if not self.session_fault(e):
+                raise
+            l.debug(
+                '%s failed, logging in again: %s',
+                name,
+                e.faultString
+            )
+            self.invalidate(sid)
+            return self.method(name)(self.get_sid(), *args)
+
+    # Make several calls, given as (method name, args) tuples, and return
+    # their results in order. Calls are batched with system.multicall and a
+    # call that failed inside a batch is retried on its own.
+    def call_many(self, calls):
+        if not self.multicall or len(calls) < 2:
+            return [self.call(name, *args) for name, args in calls]
+
+        results = []
+        for i in range(0, len(calls), self.batch_size):
+            batch = calls[i:i + self.batch_size]
+            sid = self.get_sid()
+
+            multicall = MultiCall(self.server)
+            for name, args in batch:
+                self.method(name, multicall)(sid, *args)
+
+            try:
+                batch_results = multicall()
+            except Fault as e:
+                # The MS API does not know system.multicall
+                l.info('MS API multicall not available, using single calls: {error}'.format(
+                    error=e
+                ))
+                self.multicall = False
+                results.extend(self.call(name, *args) for name, args in batch)
+                continue
+            except ProtocolError as e:
+                # An HTTP error can be temporary, only this batch is sent as
+                # single calls
+                l.warning('MS API multicall failed, using single calls: {error}'.format(
+                    error=e
+                ))
+                results.extend(self.call(name, *args) for name, args in batch)
+                continue
+
+            for j, (name, args) in enumerate(batch):
+                try:
+                    results.append(batch_results[j])
+                except Fault as e:
+                    results.append(self.call(name, *args))
+
+        return results
+
+
+# Return the first entity of an r_get2 result, or None if nothing matched
+def first_match(data):
+    if not len(data['matches']):
+        return None
+    return data['entity_data'][data['matches'][0]]
+
+
+# IDs come as numbers from the MS API and as text from alerts and the
+# command line, the cache keys them as text
+def cache_key(kind, entity_id):
+    return (kind, str(entity_id))
+
+
+class MetadataCache(object):
+    """Caches MS API records by kind and ID, each kind with its own TTL in
+    seconds. Lookups that found nothing are cached as None so unknown IDs
+    are not asked for on every alert. Kinds without a TTL are not cached.
+    """
+
+    def __init__(self, ttls, max_entries=10000):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns (found, record)
+    def get(self, kind, entity_id):
+        with self.lock:
+            entry = self.entries.get(cache_key(kind, entity_id))
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, None
+
+    def set(self, kind, entity_id, record):
+        ttl = self.ttls.get(kind)
+        if not ttl:
+            return
+
+        now = time.time()
+        with self.lock:
+            self.entries[cache_key(kind, entity_id)] = (now + ttl, record)
+
+            if len(self.entries) > self.max_entries:
+                self._expire(now)
+            # Still full, drop the oldest entries
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+
+    # Must hold the lock
+    def _expire(self, now):
+        for key, entry in list(self.entries.items()):
+            if entry[0] <= now:
+                del self.entries[key]
+
+    # Forget one entry, every entry of a kind, or everything
+    def invalidate(self, kind=None, entity_id=None):
+        with self.lock:
+            if kind is None:
+                self.entries.clear()
+            elif entity_id is None:
+                for key in list(self.entries):
+                    if key[0] == kind:
+                        del self.entries[key]
+            else:
+                self.entries.pop(cache_key(kind, entity_id), None)
+
+    # Write unexpired entries to a JSON snapshot, replacing it atomically
+    def save(self, path):
+        with self.lock:
+            self._expire(time.time())
+            snapshot = [
+                [kind, entity_id, expires, record]
+                for (kind, entity_id), (expires, record)
+                in self.entries.items()
+            ]
+
+        tmp_path = '{path}.{pid}'.format(path=path, pid=os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.rename(tmp_path, path)
+
+    def load(self, path):
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            l.debug('No usable cache snapshot in %s: %s', path, e)
+            return
+
+        now = time.time()
+        with self.lock:
+            for kind, entity_id, expires, record in snapshot:
+                if expires > now and self.ttls.get(kind):
+                    self.entries[cache_key(kind, entity_id)] = (
+                        expires,
+                        record
+                    )
@@ -0,0 +1,95 @@
+# Concurrent notification delivery for dispatch_ms.
+#
+# Every channel (email, pager) has its own pool of sender threads and its
+# own token bucket, so a long contact list is sent in parallel while each
+# gateway sees at most the configured rate. The buckets live in this
+# process, the rate holds across alerts only in the dispatch_ms service.
+
+import time
+import threading
+from logging import getLogger
+
+from ecs.ratelimit import TokenBucket
+from ecs.workers import AlertQueue, WorkerPool
+
+l = getLogger('ecs')
+
+
+class Notification(object):
+
+    def __init__(self, channel, recipient, send, args):
+        self.channel = channel
+        self.recipient = recipient
+        self.send = send
+        self.args = args
+        self.ok = False
+        self.error = None
+        self.duration = None
+
+
+class Channel(object):
+
+    def __init__(self, name, concurrency, rate, burst=None):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.queue = AlertQueue(0)
+        self.pool = WorkerPool(self.queue, self._send, concurrency)
+        self.pool.start()
+
+    def _send(self, item):
+        notification, done = item
+        self.bucket.wait()
+
+        started = time.time()
+        try:
+            returncode = notification.send(
+                notification.recipient,
+                *notification.args
+            )
+            notification.ok = not returncode
+            if returncode:
+                notification.error = 'exit {code}'.format(code=returncode)
+        except Exception as e:
+            l.exception('{channel} to {recipient} failed with exception'.format(
+                channel=self.name,
+                recipient=notification.recipient
+            ))
+            notification.error = str(e)
+        finally:
+            notification.duration = time.time() - started
+            done()
+
+
+class Notifier(object):
+
+    def __init__(self):
+        self.channels = {}
+
+    def add_channel(self, name, concurrency=4, rate=0, burst=None):
+        self.channels[name] = Channel(name, concurrency, rate, burst)
+
+    def rate_limited(self):
+        return any(
+            channel.bucket.rate for channel in self.channels.values()
+        )
+
+    # Send all notifications and wait until every one has finished
+    def send(self, notifications):
+        cond = threading.Condition()
+        remaining = [len(notifications)]
+
+        def done():
+            with cond:
+                remaining[0] -= 1
+                cond.notify()
+
+        for notification in notifications:
+            self.channels[notification.channel].queue.put(
+                (notification, done)
+            )
+
+        with cond:
+            while remaining[0]:
+                cond.wait()
+
+        return notifications
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# Replays callbacks recorded with record_file against the ECS API and
+# reports latency percentiles, throughput and errors.
+#
+# By default the WSGI application in ecsapi.py is driven in process, using
+# the configuration next to ecsapi.py just like the API, but without its
+# spool and record file. With --url the callbacks are sent over HTTP to a
+# running API instead.
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import threading
+from io import BytesIO
+from argparse import ArgumentParser
+from collections import Counter
+from wsgiref.util import setup_testing_defaults
+try:
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib import urlencode
+    from urllib2 import urlopen, HTTPError
+
+parser = ArgumentParser(
+    description='Replay recorded callbacks against the ECS API.'
+)
+
+parser.add_argument(
+    'record_file',
+    help='JSON lines file written by the record_file option'
+)
+
+parser.add_argument(
+    '--url',
+    help='Send callbacks over HTTP to this URL instead of in process'
+)
+
+parser.add_argument(
+    '--rate',
+    type=float,
+    default=0,
+    help='Send this many callbacks per second'
+)
+
+parser.add_argument(
+    '--speed',
+    type=float,
+    default=0,
+    help=('Replay at the recorded timing multiplied by this speed, 0 sends'
+          ' as fast as possible unless --rate is given')
+)
+
+parser.add_argument(
+    '--concurrency',
+    type=int,
+    default=1,
+    help='Number of callbacks in flight at once'
+)
+
+parser.add_argument(
+    '--repeat',
+    type=int,
+    default=1,
+    help='Replay the recorded callbacks this many times'
+)
+
+parser.add_argument(
+    '--stub-plugins',
+    action='store_true',
+    help='Replace every plugin with a no-op to measure the API alone'
+)
+
+parser.add_argument(
+    '--no-dedup',
+    action='store_true',
+    help='Disable duplicate suppression in process'
+)
+
+parser.add_argument(
+    '--drain',
+    action='store_true',
+    help='Wait until every queued alert is handled in process before reporting'
+)
+
+
+class NoopPlugin(object):
+
+    def setup(self, config, logging):
+        pass
+
+    def handle(self, alert):
+        pass
+
+
+# A loaded plugin loader with a no-op in place of the plugin, the registry
+# expects loaders
+def stub_plugin(name, loader):
+    from ecs.plugins import PluginLoader
+
+    stub = PluginLoader(name, loader.value, loader.config, loader.l)
+    stub.inst = NoopPlugin()
+    return stub
+
+
+worker_failures = [0]
+worker_failures_lock = threading.Lock()
+
+
+# Count alerts the in process workers failed to handle
+def count_failures(handler):
+    def handle(item):
+        try:
+            handler(item)
+        except Exception:
+            with worker_failures_lock:
+                worker_failures[0] += 1
+            raise
+    return handle
+
+
+# Plugin exceptions and timeouts are handled by the registry, read them
+# from the metrics
+def plugin_failures():
+    from ecs.metrics import metrics
+
+    return sum(
+        value for (name, labels), value in metrics.collect().items()
+        if name in ('ecs_plugin_exceptions_total', 'ecs_plugin_timeouts_total')
+    )
+
+
+def load_records(path, repeat):
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    # Repeated rounds keep the recorded spacing after each other
+    if records and repeat > 1:
+        span = records[-1]['time'] - records[0]['time'] + 1
+        records = [
+            dict(record, time=record['time'] + span * i)
+            for i in range(repeat)
+            for record in records
+        ]
+    return records
+
+
+def wsgi_sender(application):
+    def send(record):
+        environ = {}
+        setup_testing_defaults(environ)
+        environ['QUERY_STRING'] = urlencode(record['params'])
+        environ['REMOTE_ADDR'] = record.get('client') or '127.0.0.1'
+        environ['wsgi.input'] = BytesIO()
+
+        status = []
+
+        def start_response(s, headers, exc_info=None):
+            status.append(s)
+
+        body = application(environ, start_response)
+        for chunk in body:
+            pass
+        if hasattr(body, 'close'):
+            body.close()
+        return int(status[0].split(' ')[0])
+    return send
+
+
+def http_sender(url):
+    def send(record):
+        try:
+            resp = urlopen('{url}?{query}'.format(
+                url=url,
+                query=urlencode(record['params'])
+            ))
+            resp.read()
+            return resp.getcode()
+        except HTTPError as e:
+            return e.code
+    return send
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def replay(records, send, args):
+    # Seconds after start that each callback should be sent
+    if args.rate:
+        offsets = [i / args.rate for i in range(len(records))]
+    elif args.speed and records:
+        first = records[0]['time']
+        offsets = [(r['time'] - first) / args.speed for r in records]
+    else:
+        offsets = [0] * len(records)
+
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    position = [0]
+    start = time.time()
+
+    def worker():
+        while True:
+            with lock:
+                i = position[0]
+                position[0] += 1
+            if i >= len(records):
+                return
+
+            delay = start + offsets[i] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            sent = time.time()
+            try:
+                status = send(records[i])
+            except Exception as e:
+                status = type(e).__name__
+            latency = time.time() - sent
+
+            with lock:
+                latencies.append(latency)
+                statuses[status] += 1
+
+    threads = [
+        threading.Thread(target=worker) for i in range(args.concurrency)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return time.time() - start, sorted(latencies), statuses
+
+
+def main():
+    args = parser.parse_args()
+    records = load_records(args.record_file, args.repeat)
+
+    ecsapi = None
+    if args.url:
+        send = http_sender(args.url)
+    else:
+        sys.path.insert(
+            0,
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        )
+        import ecsapi
+        from bottle import default_app
+        from ecs.plugins import PluginRegistry
+
+        # Do not replay the spool of the API or record the replayed
+        # callbacks again
+        ecsapi.config.set('spool', 'directory', '')
+        ecsapi.config.set('api', 'record_file', '')
+        if args.no_dedup:
+            ecsapi.config.set('dedup', 'window', '0')
+
+        # Stubs are in place before any worker starts, the plugins are
+        # found but never imported
+        plugins = None
+        if args.stub_plugins:
+            plugins = PluginRegistry()
+            plugins.load(ecsapi.config, ecsapi.h, lazy=True)
+            plugins.plugins = [
+                (name, stub_plugin(name, inst))
+                for name, inst in plugins.plugins
+            ]
+
+        ecsapi.setup_app(plugins=plugins)
+        if ecsapi.worker_pool is not None:
+            ecsapi.worker_pool.handler = count_failures(
+                ecsapi.worker_pool.handler
+            )
+        send = wsgi_sender(default_app())
+
+    started = time.time()
+    elapsed, latencies, statuses = replay(records, send, args)
+
+    # Stopping the workers waits for every queued alert to be handled
+    drained = None
+    if args.drain and ecsapi is not None and ecsapi.alert_queue is not None:
+        ecsapi.shutdown_app()
+        drained = time.time() - started
+
+    errors = sum(
+        count for status, count in statuses.items()
+        if not isinstance(status, int) or status >= 400
+    )
+
+    print('Callbacks:   {count}'.format(count=len(latencies)))
+    print('Elapsed:     {elapsed:.3f}s'.format(elapsed=elapsed))
+    print('Throughput:  {rate:.1f}/s'.format(
+        rate=len(latencies) / elapsed if elapsed else 0
+    ))
+    print('Latency p50: {0:.2f}ms p95: {1:.2f}ms p99: {2:.2f}ms max: {3:.2f}ms'.format(
+        percentile(latencies, 50) * 1000,
+        percentile(latencies, 95) * 1000,
+        percentile(latencies, 99) * 1000,
+        (latencies[-1] if latencies else 0) * 1000
+    ))
+    print('Errors:      {errors}'.format(errors=errors))
+    if ecsapi is not None:
+        print('Worker errors: {workers}, plugin errors: {plugins}'.format(
+            workers=worker_failures[0],
+            plugins=plugin_failures()
+        ))
+    print('Statuses:    {statuses}'.format(statuses=', '.join(
+        '{0}: {1}'.format(status, count)
+        for status, count in sorted(statuses.items(), key=str)
+    )))
+    if drained is not None:
+        print('Queue drained: {0:.3f}s'.format(drained))
+
+
+if __name__ == '__main__':
+    main()
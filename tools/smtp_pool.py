@@ -0,0 +1,85 @@
+# Pool of persistent SMTP connections for dispatch_ms e-mail alerts.
+#
+# Connections are reused for up to max_messages messages before they are
+# closed, so sending a burst of alerts costs a few SMTP sessions instead of
+# one sendmail process per recipient.
+
+import socket
+import smtplib
+import threading
+from logging import getLogger
+
+l = getLogger('ecs')
+
+
+class SMTPPool(object):
+
+    def __init__(self, host, port=25, size=2, max_messages=100, timeout=30,
+                 starttls=False, username=None, password=None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+
+        # Idle connections as [smtp, messages sent]
+        self.idle = []
+        self.lock = threading.Lock()
+        self.available = threading.Semaphore(size)
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password)
+        return [smtp, 0]
+
+    def _close(self, conn):
+        try:
+            conn[0].quit()
+        except (smtplib.SMTPException, socket.error) as e:
+            conn[0].close()
+
+    # Send a message to every recipient in one envelope
+    def send(self, from_addr, recipients, message):
+        self.available.acquire()
+        try:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect()
+
+            try:
+                refused = conn[0].sendmail(from_addr, recipients, message)
+            except smtplib.SMTPServerDisconnected as e:
+                if not reused:
+                    raise
+                # The server closed the idle connection, use a new one
+                conn = self._connect()
+                refused = conn[0].sendmail(from_addr, recipients, message)
+            except Exception as e:
+                self._close(conn)
+                raise
+
+            conn[1] += 1
+            if conn[1] >= self.max_messages:
+                self._close(conn)
+            else:
+                with self.lock:
+                    self.idle.append(conn)
+
+            return refused
+        finally:
+            self.available.release()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            self._close(conn)